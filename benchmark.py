@@ -0,0 +1,297 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+import yaml
+
+from lib.millionpages import MillionPages
+
+parser = argparse.ArgumentParser(
+    description="millionpages benchmark, on a generated (synthetic) site"
+)
+parser.add_argument("--pages", type=int, default=10000, help="number of pages")
+parser.add_argument(
+    "--cardinality",
+    type=int,
+    default=50,
+    help="number of different values for every grouped front-matter key",
+)
+parser.add_argument(
+    "--depth", type=int, default=2, help="nesting depth of the __index__.yaml folders"
+)
+parser.add_argument(
+    "--fanout", type=int, default=2, help="number of groups on every index"
+)
+parser.add_argument(
+    "--images", type=int, default=0, help="number of images used on the pages"
+)
+parser.add_argument("--jobs", type=int, default=1, help="as for index.py build")
+parser.add_argument(
+    "--low-memory", action="store_true", help="as for index.py build"
+)
+parser.add_argument("--seed", type=int, default=1)
+parser.add_argument(
+    "--path",
+    help="folder for the generated site, a temporary folder that is removed afterwards if not given",
+)
+parser.add_argument(
+    "--output", default="benchmark.json", help="json file for the results"
+)
+parser.add_argument(
+    "--compare", help="json file with earlier results, to compare the timings with"
+)
+
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+    "incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud "
+    "exercitation ullamco laboris nisi aliquip ex ea commodo consequat duis aute "
+    "irure in reprehenderit voluptate velit esse cillum fugiat nulla pariatur "
+    "excepteur sint occaecat cupidatat non proident sunt culpa qui officia deserunt "
+    "mollit anim id est laborum"
+).split()
+
+TEMPLATES = {
+    "site.html": (
+        '<html><head><title>{{ site.title }}</title><link rel="stylesheet" '
+        'href="/style/site.css"></head>\n<body><nav>{% for item in menu.items %}'
+        '<a href="{{ item.path }}">{{ item.config.title }}</a>{% endfor %}</nav>\n'
+        "{% block content %}{% endblock %}</body></html>\n"
+    ),
+    "page.html": (
+        '{% extends "_templates/site.html" %}\n{% block content %}'
+        "<h1>{{ page.config.title }}</h1>{% if page.config.image %}"
+        "<img {{ page.config.image|imageattrs(400) }}>{% endif %}"
+        "{{ page.content|safe }}{% endblock %}\n"
+    ),
+    "index.html": (
+        '{% extends "_templates/site.html" %}\n{% block content %}'
+        "<h1>{{ index.config.title }}</h1><ul>{% for page in index.pages %}"
+        '<li><a href="{{ page.url }}">{{ page.config.title }}</a></li>{% endfor %}'
+        "</ul>{% if pagination and pagination.next %}"
+        '<a href="{{ pagination.next }}">next</a>{% endif %}{% endblock %}\n'
+    ),
+}
+
+
+def sentence(rng, length):
+    return " ".join(rng.choice(WORDS) for _ in range(length))
+
+
+def make_folders(depth):
+    # every folder has two subfolders, down to depth levels below the root
+    folders = [""]
+    level = [""]
+    for _ in range(depth):
+        level = [f"{folder}/s{n}" for folder in level for n in range(2)]
+        folders.extend(level)
+    return folders
+
+
+def make_site(basedir, options):
+    rng = random.Random(options.seed)
+    siteconfig = {"title": "Benchmark", "domain": "https://example.com"}
+    os.makedirs(basedir, exist_ok=True)
+    with open(os.path.join(basedir, "__site__.yaml"), "w") as f:
+        yaml.safe_dump(siteconfig, f)
+
+    templatespath = os.path.join(basedir, "theme", "_templates")
+    os.makedirs(templatespath, exist_ok=True)
+    for name, template in TEMPLATES.items():
+        with open(os.path.join(templatespath, name), "w") as f:
+            f.write(template)
+    os.makedirs(os.path.join(basedir, "theme", "style"), exist_ok=True)
+    with open(os.path.join(basedir, "theme", "style", "site.css"), "w") as f:
+        f.write("body { font-family: sans-serif; }\n")
+
+    sitepath = os.path.join(basedir, "site")
+    folders = make_folders(options.depth)
+    for folder in folders:
+        os.makedirs(sitepath + folder, exist_ok=True)
+        # every index filters on its own folder, orders, groups and paginates
+        pages = {"order": "date desc", "paginate": 20}
+        if folder:
+            level = folder.count("/")
+            pages["filter"] = {f"level{level}": folder}
+        pages["groups"] = [
+            {"by": f"key{n}", "title": "{{ group }}", "paginate": 20}
+            for n in range(options.fanout)
+        ]
+        config = {"title": folder or "Home", "pages": pages}
+        with open(os.path.join(sitepath + folder, "__index__.yaml"), "w") as f:
+            yaml.safe_dump(config, f)
+
+    if options.images:
+        from PIL import Image
+
+        os.makedirs(os.path.join(sitepath, "images"), exist_ok=True)
+        for n in range(options.images):
+            color = tuple(rng.randrange(256) for _ in range(3))
+            image = Image.new("RGB", (800, 600), color)
+            image.save(os.path.join(sitepath, "images", f"image{n}.jpg"))
+
+    for n in range(options.pages):
+        folder = rng.choice(folders)
+        config = {
+            "title": sentence(rng, 4).capitalize(),
+            "date": f"20{rng.randrange(10, 20)}-{rng.randrange(1, 13):02}-{rng.randrange(1, 29):02}",
+        }
+        parts = folder.split("/")
+        for level in range(1, len(parts)):
+            config[f"level{level}"] = "/".join(parts[: level + 1])
+        for key in range(options.fanout):
+            config[f"key{key}"] = [
+                f"value{rng.randrange(options.cardinality)}"
+                for _ in range(rng.randint(1, 3))
+            ]
+        if options.images:
+            config["image"] = f"/images/image{n % options.images}.jpg"
+        paragraphs = [sentence(rng, rng.randint(40, 120)) for _ in range(4)]
+        content = f"# {config['title']}\n\n" + "\n\n".join(paragraphs)
+        pathname = os.path.join(sitepath + folder, f"page{n}.md")
+        with open(pathname, "w") as f:
+            f.write("---\n" + yaml.safe_dump(config) + "---\n" + content + "\n")
+    return siteconfig
+
+
+def make_millionpages(basedir, siteconfig, jobs, lowmemory):
+    return MillionPages(
+        siteconfig,
+        siteconfig["title"],
+        os.path.join(basedir, "site"),
+        os.path.join(basedir, "theme"),
+        "_templates",
+        os.path.join(basedir, "upload-generated-site"),
+        os.path.join(basedir, ".millionpages-cache"),
+        jobs=jobs,
+        lowmemory=lowmemory,
+    )
+
+
+def peak_rss():
+    # in MB, ru_maxrss is in kilobytes on linux, but in bytes on macos
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_scenario(scenario, basedir, siteconfig, jobs, lowmemory, results):
+    # runs in its own process, so the peak memory use is for this scenario
+    millionpages = make_millionpages(basedir, siteconfig, jobs, lowmemory)
+    if scenario == "incremental":
+        millionpages.go()
+        pathname = os.path.join(basedir, "site", "page0.md")
+        for folder, dirs, files in os.walk(os.path.join(basedir, "site")):
+            if "page0.md" in files:
+                pathname = os.path.join(folder, "page0.md")
+        with open(pathname, "a") as f:
+            f.write("\nOne more paragraph for the incremental generation.\n")
+        changes = {pathname}
+    else:
+        changes = None
+    start = time.perf_counter()
+    millionpages.go(changes)
+    wall = time.perf_counter() - start
+    statuses = list(millionpages.output.values())
+    results.put(
+        {
+            "wall": wall,
+            "peak-rss-mb": peak_rss(),
+            "phases": millionpages.timings,
+            "pages": len(millionpages.pages),
+            "outputs": len(statuses),
+            "written": len(statuses) - statuses.count(0),
+            "errors": len(millionpages.errors),
+        }
+    )
+
+
+def run(basedir, siteconfig, jobs, lowmemory):
+    context = multiprocessing.get_context("spawn")
+    runs = {}
+    for scenario in ("cold", "warm", "incremental"):
+        if scenario == "cold":
+            for folder in ("upload-generated-site", ".millionpages-cache"):
+                shutil.rmtree(os.path.join(basedir, folder), ignore_errors=True)
+        results = context.Queue()
+        process = context.Process(
+            target=run_scenario,
+            args=(scenario, basedir, siteconfig, jobs, lowmemory, results),
+        )
+        process.start()
+        runs[scenario] = results.get()
+        process.join()
+    return runs
+
+
+def version():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+def print_runs(runs, previous=None):
+    print()
+    for scenario, result in runs.items():
+        line = f"{scenario:12}: {result['wall']:8.2f}s {result['peak-rss-mb']:8.0f}MB"
+        if previous and scenario in previous:
+            ratio = result["wall"] / max(previous[scenario]["wall"], 1e-9)
+            line += f" ({ratio:.2f}x)"
+        print(line)
+        for phase, seconds in result["phases"].items():
+            line = f"  {phase:10}: {seconds:8.2f}s"
+            earlier = previous and previous.get(scenario, {}).get("phases", {})
+            if earlier and phase in earlier:
+                line += f" ({seconds / max(earlier[phase], 1e-9):.2f}x)"
+            print(line)
+
+
+if __name__ == "__main__":
+    options = parser.parse_args()
+    basedir = options.path or tempfile.mkdtemp(prefix="millionpages-benchmark-")
+    try:
+        start = time.perf_counter()
+        siteconfig = make_site(basedir, options)
+        print(f"generated the site in {time.perf_counter() - start:.2f}s: {basedir}")
+        runs = run(basedir, siteconfig, max(1, options.jobs), options.low_memory)
+    finally:
+        if not options.path:
+            shutil.rmtree(basedir, ignore_errors=True)
+
+    report = {
+        "version": version(),
+        "parameters": {
+            key: getattr(options, key)
+            for key in (
+                "pages",
+                "cardinality",
+                "depth",
+                "fanout",
+                "images",
+                "jobs",
+                "low_memory",
+                "seed",
+            )
+        },
+        "runs": runs,
+    }
+    with open(options.output, "w") as f:
+        json.dump(report, f, indent=1)
+
+    previous = None
+    if options.compare:
+        with open(options.compare) as f:
+            previous = json.load(f)["runs"]
+    print_runs(runs, previous)
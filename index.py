@@ -1,19 +1,56 @@
 import os
 import sys
+import json
+import asyncio
+import cProfile
 import yaml
+import argparse
 
 from sanic import Sanic
 from sanic import response
-from urllib.parse import unquote
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
 import multiprocessing
 import queue
-import time
 
 from lib.tools import parse
 from lib.millionpages import MillionPages
+from lib.staticfiles import StaticFiles
+from lib.imagetools import LazyImages
+from lib.scheduler import BuildScheduler
+from lib.livereload import LIVERELOAD_PATH, SCRIPT, inject_script, output_urls
+
+parser = argparse.ArgumentParser(description="millionpages static site generator")
+parser.add_argument(
+    "command",
+    nargs="?",
+    choices=("serve", "build", "precompile"),
+    default="serve",
+    help="serve (the default) generates, serves and watches the site, build only generates it, precompile compiles the theme templates for --precompiled",
+)
+parser.add_argument(
+    "--jobs",
+    type=int,
+    default=1,
+    help="number of worker processes that render pages in parallel",
+)
+parser.add_argument(
+    "--precompiled",
+    action="store_true",
+    help="use the templates compiled by precompile, instead of the theme templates",
+)
+parser.add_argument(
+    "--low-memory",
+    action="store_true",
+    help="keep only the front-matter of the pages in memory, for very large sites",
+)
+parser.add_argument(
+    "--profile",
+    metavar="FILE",
+    help="write python profiler statistics of the (first) generation to FILE",
+)
+args = parser.parse_args()
 
 basedir = os.getcwd()
 siteconfigpath = os.path.join(basedir, "__site__.yaml")
@@ -49,54 +86,202 @@ exportpath = os.path.abspath(
 if not exportpath.startswith(basedir):
     exportpath = os.path.join(basedir, "upload-generated-site")
 
+cachepath = os.path.abspath(
+    os.path.join(basedir, siteconfig["build-cache"])
+    if "build-cache" in siteconfig
+    else os.path.join(basedir, ".millionpages-cache")
+)
+
+precompiledpath = os.path.abspath(
+    os.path.join(basedir, siteconfig["precompiled-templates"])
+    if "precompiled-templates" in siteconfig
+    else os.path.join(basedir, "precompiled-templates")
+)
+
 millionpages = MillionPages(
-    siteconfig, title, sitepath, themepath, templatesfolder, exportpath
+    siteconfig,
+    title,
+    sitepath,
+    themepath,
+    templatesfolder,
+    exportpath,
+    cachepath,
+    jobs=max(1, args.jobs),
+    precompiledpath=precompiledpath if args.precompiled else None,
+    lowmemory=args.low_memory,
+    lazyimages=args.command == "serve",
 )
 
-# we'll put any fs events in the queue
+# we'll put the paths from any fs events in the queue
 class MillionPagesFileSystemEventHandler(FileSystemEventHandler):
     def __init__(self, queue):
         self.queue = queue
 
     def on_any_event(self, event):
-        self.queue.put(event)
+        # a modified folder only means something changed inside it, and
+        # that has its own event
+        if event.is_directory and event.event_type == "modified":
+            return
+        self.queue.put(event.src_path)
+        if hasattr(event, "dest_path"):
+            self.queue.put(event.dest_path)
 
 
-# if there's fs events in the queue, consume them all, then execute
-# new site generation
-# this way we won't rerun the generation when there's a bunch of fs events
-# at the same time, e.g. when copying a folder of images into the site folder,
-# or moving files and folders around.
-def buffered_go_millionpages(q, millionpages):
-    while True:
-        event = None
-        try:
-            while True:
-                event = q.get_nowait()
-        except queue.Empty:
-            if event:
-                print(event.src_path)
-                millionpages.go()
-            time.sleep(1)
+# the fs events are collected until they stop coming in for a moment, then
+# the site is generated for all the changed paths at once, this way we won't
+# rerun the generation when there's a bunch of fs events at the same time,
+# e.g. when copying a folder of images into the site folder, or moving files
+# and folders around. a generation that is still busy when new events come in
+# is interrupted, and started again for all the changes.
+def buffered_go_millionpages(q, millionpages, buildcounter, builds):
+    def build(changes, interrupted):
+        for pathname in sorted(changes):
+            print(pathname)
+        if not millionpages.go(changes, interrupted):
+            return False
+        with buildcounter.get_lock():
+            buildcounter.value += 1
+        changed = [
+            destination for destination, status in millionpages.output.items() if status
+        ]
+        builds.put(output_urls(millionpages.exportpath, changed))
+        return True
+
+    quietperiod = siteconfig.get("watch-quiet-period", 50) / 1000
+    BuildScheduler(q, build, quietperiod).run()
 
 
 app = Sanic()
 
 
+# the generation process counts its builds, the server forgets what it knows
+# about the generated files when the count changes
+buildcounter = multiprocessing.Value("i", 0)
+staticfiles = StaticFiles(exportpath, buildcounter, exportpath + ".assets.json")
+# resized images are generated when they're first requested
+lazyimages = LazyImages(
+    exportpath + ".images.json", buildcounter, millionpages.encodecache
+)
+
+# and it sends the url paths it changed, for the live reload websockets
+builds = multiprocessing.Queue()
+livereloadsockets = set()
+
+# files larger than this are streamed in chunks instead of read at once
+STREAM_SIZE = 1024 * 1024
+
+
 @app.middleware("request")
 async def static(request):
-    fullpath = os.path.join(exportpath, unquote(request.path[1:]))
-    if os.path.isdir(fullpath):
-        fullpath = os.path.join(fullpath, "index.html")
-    if os.path.isfile(fullpath):
-        return await response.file(fullpath)
+    if request.path == LIVERELOAD_PATH:
+        return  # handled by the websocket route
+    job = lazyimages.lookup(request.path)
+    if job:
+        loop = asyncio.get_event_loop()
+        error = await loop.run_in_executor(None, lazyimages.generate, job)
+        if error:
+            print(error)
+        staticfiles.forget(request.path)
+    staticfile = staticfiles.lookup(request.path)
+    if not staticfile:
+        return response.html("<h1>404 Not Found</h1>", status=404)
+
+    rangeheader = request.headers.get("range")
+    # pages get the live reload script, so they're always served as is
+    livereload = staticfile.mimetype == "text/html" and not rangeheader
+    if not rangeheader and not livereload:
+        # serve the precompressed sidecar, like the production server would
+        staticfile = staticfile.negotiate(request.headers.get("accept-encoding"))
+    headers = staticfile.headers()
+    if staticfile.not_modified(request.headers):
+        return response.HTTPResponse(status=304, headers=headers)
+    try:
+        byterange = staticfile.byterange(rangeheader)
+    except ValueError:
+        headers["Content-Range"] = f"bytes */{staticfile.size}"
+        return response.HTTPResponse(status=416, headers=headers)
+    # sanic leaves the status of a range at 200, so it is passed along, with
+    # the Content-Range for every kind of response
+    status = 206 if byterange else 200
+    if byterange:
+        headers["Content-Range"] = (
+            f"bytes {byterange.start}-{byterange.end}/{byterange.total}"
+        )
+
+    if request.method == "HEAD":
+        size = staticfile.size
+        if livereload:
+            size += len(SCRIPT.encode("utf-8"))
+        headers["Content-Length"] = str(byterange.size if byterange else size)
+        return response.HTTPResponse(
+            status=status, headers=headers, content_type=staticfile.mimetype
+        )
+    if livereload:
+        with open(staticfile.location, "r", encoding="utf-8") as htmlfile:
+            html = inject_script(htmlfile.read())
+        return response.html(html, headers=headers)
+    if (byterange.size if byterange else staticfile.size) > STREAM_SIZE:
+        return await response.file_stream(
+            staticfile.location,
+            status=status,
+            chunk_size=64 * 1024,
+            mime_type=staticfile.mimetype,
+            headers=headers,
+            _range=byterange,
+        )
+    return await response.file(
+        staticfile.location,
+        status=status,
+        mime_type=staticfile.mimetype,
+        headers=headers,
+        _range=byterange,
+    )
+
+
+@app.websocket(LIVERELOAD_PATH)
+async def livereload(request, ws):
+    livereloadsockets.add(ws)
+    try:
+        while True:
+            await ws.recv()  # until the browser goes away
+    finally:
+        livereloadsockets.discard(ws)
+
+
+async def publish_builds():
+    # pass the changed url paths from the generation process to the browsers
+    loop = asyncio.get_event_loop()
+    while True:
+        try:
+            urls = await loop.run_in_executor(None, builds.get, True, 1)
+        except queue.Empty:
+            continue
+        message = json.dumps(urls)
+        for ws in list(livereloadsockets):
+            try:
+                await ws.send(message)
+            except Exception:
+                livereloadsockets.discard(ws)
 
 
 if __name__ == "__main__":
-    millionpages.go()
+    if args.command == "precompile":
+        millionpages.precompile_templates(precompiledpath)
+        sys.exit(0)
+
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.runcall(millionpages.go)
+        profiler.dump_stats(args.profile)
+    else:
+        millionpages.go()
+    if args.command == "build":
+        sys.exit(1 if millionpages.errors else 0)
 
     q = multiprocessing.Queue()
-    p = multiprocessing.Process(target=buffered_go_millionpages, args=(q, millionpages))
+    p = multiprocessing.Process(
+        target=buffered_go_millionpages, args=(q, millionpages, buildcounter, builds)
+    )
     p.start()
 
     event_handler = MillionPagesFileSystemEventHandler(q)
@@ -105,6 +290,7 @@ if __name__ == "__main__":
     observer.schedule(event_handler, themepath, recursive=True)
     observer.start()
 
+    app.add_task(publish_builds())
     app.run(host="0.0.0.0", port=10002)
 
     observer.stop()
@@ -0,0 +1,412 @@
+import json
+import bisect
+
+# pure python minifiers for the bundled javascript and stylesheets, they only
+# leave out comments and whitespace (javascript keeps the line breaks that may
+# end a statement), so they are safe rather than the smallest, every token
+# keeps its offset in the source file, for the source map
+
+BASE64 = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+
+# after these, a / starts a regular expression instead of a division
+JS_EXPRESSION_KEYWORDS = {
+    "return",
+    "typeof",
+    "instanceof",
+    "in",
+    "of",
+    "new",
+    "delete",
+    "void",
+    "throw",
+    "case",
+    "do",
+    "else",
+    "yield",
+    "await",
+}
+# a line break right after these ends the statement, so it stays
+JS_RESTRICTED_KEYWORDS = {"return", "break", "continue", "throw", "yield"}
+# a line break after or before these characters can't end a statement
+JS_JOIN_AFTER = set("{([;,=:?!&|*%<>~^.+-")
+JS_JOIN_BEFORE = set("})];,=:?&|*%<>^.")
+# these characters would form a different token when they touch
+JS_SEPARATE = {("+", "+"), ("-", "-"), ("/", "/"), ("/", "*"), ("<", "!"), ("-", ">")}
+
+CSS_JOIN = set("{};,>:(")
+CSS_JOIN_BEFORE = set("{};,>)")
+
+
+def is_word_character(character):
+    return character.isalnum() or character in "_$\\" or ord(character) > 127
+
+
+def scan_string(text, start):
+    # the end of the quoted string at start
+    quote = text[start]
+    i = start + 1
+    while i < len(text):
+        if text[i] == "\\":
+            i += 2
+        elif text[i] == quote:
+            return i + 1
+        elif text[i] == "\n":
+            break
+        else:
+            i += 1
+    raise ValueError(f"unterminated string at offset {start}")
+
+
+def scan_template(text, start):
+    # the end of the template literal at start, with ${} expressions that
+    # may hold strings and template literals themselves
+    i = start + 1
+    while i < len(text):
+        if text[i] == "\\":
+            i += 2
+        elif text[i] == "`":
+            return i + 1
+        elif text.startswith("${", i):
+            i += 2
+            depth = 1
+            while i < len(text) and depth:
+                if text[i] in "'\"":
+                    i = scan_string(text, i)
+                    continue
+                if text[i] == "`":
+                    i = scan_template(text, i)
+                    continue
+                if text[i] == "{":
+                    depth += 1
+                elif text[i] == "}":
+                    depth -= 1
+                i += 1
+        else:
+            i += 1
+    raise ValueError(f"unterminated template literal at offset {start}")
+
+
+def scan_regex(text, start):
+    # the end of the regular expression at start (with its flags), or None
+    # if it isn't one after all
+    i = start + 1
+    inclass = False
+    while i < len(text):
+        character = text[i]
+        if character == "\\":
+            i += 2
+            continue
+        if character == "\n":
+            return None
+        if character == "[":
+            inclass = True
+        elif character == "]":
+            inclass = False
+        elif character == "/" and not inclass:
+            i += 1
+            while i < len(text) and is_word_character(text[i]):
+                i += 1
+            return i
+        i += 1
+    return None
+
+
+def regex_allowed(previous):
+    if previous is None:
+        return True
+    kind, value = previous
+    if kind == "word":
+        return value in JS_EXPRESSION_KEYWORDS
+    if kind == "punctuation":
+        return value not in (")", "]", "}", "++", "--")
+    return False
+
+
+def js_tokens(text):
+    # (kind, value, offset) for whitespace, comments, strings, regular
+    # expressions, words (names, keywords and numbers) and punctuation
+    i = 0
+    previous = None  # the last token that isn't whitespace or a comment
+    while i < len(text):
+        character = text[i]
+        if character.isspace():
+            j = i
+            while j < len(text) and text[j].isspace():
+                j += 1
+            value = text[i:j]
+            newline = any(c in "\n\r\u2028\u2029" for c in value)
+            yield ("newline" if newline else "space", value, i)
+            i = j
+            continue
+        if text.startswith("//", i) or (i == 0 and text.startswith("#!")):
+            j = text.find("\n", i)
+            j = len(text) if j < 0 else j
+            kind = "comment"
+        elif text.startswith("/*", i):
+            j = text.find("*/", i + 2)
+            if j < 0:
+                raise ValueError(f"unterminated comment at offset {i}")
+            j += 2
+            kind = "comment"
+        elif character in "'\"":
+            j = scan_string(text, i)
+            kind = "string"
+        elif character == "`":
+            j = scan_template(text, i)
+            kind = "string"
+        elif character == "/" and regex_allowed(previous) and scan_regex(text, i):
+            j = scan_regex(text, i)
+            kind = "regex"
+        elif is_word_character(character):
+            j = i
+            while j < len(text) and is_word_character(text[j]):
+                j += 1
+            kind = "word"
+        else:
+            j = i + 2 if text[i : i + 2] in ("++", "--") else i + 1
+            kind = "punctuation"
+        value = text[i:j]
+        yield (kind, value, i)
+        if kind != "comment":
+            previous = (kind, value)
+        i = j
+
+
+def js_separator(previous, token, newline):
+    # what has to stay between two tokens that had whitespace between them
+    kind, value = previous
+    last, first = value[-1], token[1][0]
+    if newline:
+        if kind == "word" and value in JS_RESTRICTED_KEYWORDS:
+            return "\n"
+        if value in ("++", "--"):
+            return "\n"
+        if last not in JS_JOIN_AFTER and first not in JS_JOIN_BEFORE:
+            return "\n"
+    if is_word_character(last) and is_word_character(first):
+        return " "
+    if (last, first) in JS_SEPARATE:
+        return " "
+    if kind == "word" and last.isdigit() and first == ".":
+        return " "  # 1 .toString()
+    return ""
+
+
+def minify_js(text):
+    # (chunk, offset) pairs, offset is None for a separator
+    previous = None
+    whitespace = None  # None, "space" or "newline"
+    for kind, value, offset in js_tokens(text):
+        if kind == "comment" and not value.startswith("/*!"):
+            if "\n" in value:
+                whitespace = "newline"
+            else:
+                whitespace = whitespace or "space"
+            continue
+        if kind in ("space", "newline"):
+            if whitespace != "newline":
+                whitespace = kind
+            continue
+        if previous and whitespace:
+            separator = js_separator(previous, (kind, value), whitespace == "newline")
+            if separator:
+                yield (separator, None)
+        yield (value, offset)
+        previous = (kind, value)
+        whitespace = "newline" if kind == "comment" else None
+
+
+def css_tokens(text):
+    # (kind, value, offset) for whitespace, comments, strings, url(...) and
+    # anything else, single punctuation characters or runs of other ones
+    i = 0
+    while i < len(text):
+        character = text[i]
+        if character.isspace():
+            j = i
+            while j < len(text) and text[j].isspace():
+                j += 1
+            kind = "space"
+        elif text.startswith("/*", i):
+            j = text.find("*/", i + 2)
+            if j < 0:
+                raise ValueError(f"unterminated comment at offset {i}")
+            j += 2
+            kind = "comment"
+        elif character in "'\"":
+            j = scan_string(text, i)
+            kind = "string"
+        elif text[i : i + 4].lower() == "url(":
+            j = i + 4
+            while j < len(text) and text[j] != ")":
+                j = scan_string(text, j) if text[j] in "'\"" else j + 1
+            if j >= len(text):
+                raise ValueError(f"unterminated url( at offset {i}")
+            j += 1
+            kind = "url"
+        elif character in "{}();:,>/":
+            j = i + 1
+            kind = "punctuation"
+        else:
+            j = i
+            while (
+                j < len(text)
+                and not text[j].isspace()
+                and text[j] not in "{}();:,>/'\""
+            ):
+                j += 1
+            kind = "word"
+        yield (kind, text[i:j], i)
+        i = j
+
+
+def minify_css(text):
+    # (chunk, offset) pairs, offset is None for a separator, the last
+    # semicolon in a block, and repeated ones, are left out too
+    previous = None
+    whitespace = False
+    semicolon = None  # a semicolon that is only written if a declaration follows
+    for kind, value, offset in css_tokens(text):
+        if kind == "comment" and not value.startswith("/*!"):
+            whitespace = True
+            continue
+        if kind == "space":
+            whitespace = True
+            continue
+        if semicolon:
+            if value not in ("}", ";"):
+                yield semicolon
+            semicolon = None
+        elif (
+            previous
+            and whitespace
+            and previous[-1] not in CSS_JOIN
+            and value[0] not in CSS_JOIN_BEFORE
+        ):
+            yield (" ", None)
+        whitespace = False
+        if value == ";":
+            semicolon = (value, offset)
+        else:
+            yield (value, offset)
+        previous = value
+    if semicolon:
+        yield semicolon
+
+
+def plain(text):
+    # (chunk, offset) pairs for a file that isn't minified, a line each
+    offset = 0
+    for line in text.splitlines(True):
+        yield (line, offset)
+        offset += len(line)
+
+
+def vlq(value):
+    # base64 variable length quantity, for the source map mappings
+    value = ((-value) << 1) | 1 if value < 0 else value << 1
+    encoded = ""
+    while True:
+        digit = value & 31
+        value >>= 5
+        if value:
+            digit |= 32
+        encoded += BASE64[digit]
+        if not value:
+            return encoded
+
+
+class SourceMap:
+    # version 3 source map with a mapping for every token, the sources are
+    # included, the underscored files aren't in the generated site
+    def __init__(self, filename):
+        self.filename = filename
+        self.sources = []
+        self.contents = []
+        self.lines = [[]]  # per bundle line, (column, source, line, column)
+
+    def add_source(self, path, text):
+        self.sources.append(path)
+        self.contents.append(text)
+
+    def add(self, column, source, line, sourcecolumn):
+        self.lines[-1].append((column, source, line, sourcecolumn))
+
+    def newlines(self, count):
+        self.lines.extend([] for _ in range(count))
+
+    def json(self):
+        previous = [0, 0, 0]  # source, line and column, over all lines
+        lines = []
+        for segments in self.lines:
+            encoded = []
+            previouscolumn = 0
+            for column, *source in segments:
+                segment = vlq(column - previouscolumn)
+                for index in range(3):
+                    segment += vlq(source[index] - previous[index])
+                encoded.append(segment)
+                previouscolumn = column
+                previous = source
+            lines.append(",".join(encoded))
+        return json.dumps(
+            {
+                "version": 3,
+                "file": self.filename,
+                "sources": self.sources,
+                "sourcesContent": self.contents,
+                "names": [],
+                "mappings": ";".join(lines),
+            }
+        )
+
+
+def make_bundle(filename, files, minify=True, sourcemaps=False):
+    # files is a list of (path, text), returns the bundle, its source map
+    # (or None) and a list of error messages, a file that can't be minified
+    # goes in as is
+    javascript = filename.endswith(".js")
+    sourcemap = SourceMap(filename) if sourcemaps else None
+    errors = []
+    parts = []
+    line = column = 0  # where the next chunk goes in the bundle
+    for source, (path, text) in enumerate(files):
+        chunks = plain(text)
+        if minify:
+            try:
+                chunks = list(minify_js(text) if javascript else minify_css(text))
+            except ValueError as e:
+                errors.append(f"bundle: {path} - {str(e)}")
+                chunks = plain(text)
+        linestarts = [0]
+        if sourcemap:
+            sourcemap.add_source(path, text)
+            linestarts += [i + 1 for i, c in enumerate(text) if c == "\n"]
+        chunks = list(chunks)
+        # every file starts on a new line, and javascript statements end
+        joined = "".join(chunk for chunk, offset in chunks)
+        separator = "" if joined.endswith("\n") else "\n"
+        if javascript and joined.strip() and not joined.rstrip().endswith(";"):
+            separator += ";\n"
+        chunks.append((separator, None))
+        for chunk, offset in chunks:
+            if sourcemap and offset is not None:
+                sourceline = bisect.bisect_right(linestarts, offset) - 1
+                sourcemap.add(
+                    column, source, sourceline, offset - linestarts[sourceline]
+                )
+            parts.append(chunk)
+            newlines = chunk.count("\n")
+            if newlines:
+                line += newlines
+                column = len(chunk) - chunk.rfind("\n") - 1
+                if sourcemap:
+                    sourcemap.newlines(newlines)
+            else:
+                column += len(chunk)
+    if sourcemap:
+        if javascript:
+            parts.append(f"//# sourceMappingURL={filename}.map\n")
+        else:
+            parts.append(f"/*# sourceMappingURL={filename}.map */\n")
+    return "".join(parts), sourcemap.json() if sourcemap else None, errors
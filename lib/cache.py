@@ -0,0 +1,132 @@
+import os
+import pickle
+import sqlite3
+import hashlib
+
+from jinja2 import FileSystemBytecodeCache
+
+# bump when the cached values change shape
+CACHE_FORMAT = 1
+
+# bump when templates compile differently, or to drop compiled templates
+# that are no longer used (2: asset became a context filter, before, jinja
+# compiled it to a constant, 3: page contents are no longer cached)
+TEMPLATES_FORMAT = 3
+
+# number of updates that are written in one go
+FLUSH_SIZE = 1000
+
+
+def make_stamp(stat):
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+
+def make_bytecode_cache(path):
+    # jinja only checks the template source, so compiled templates of
+    # another format are removed
+    os.makedirs(path, exist_ok=True)
+    suffix = f".{TEMPLATES_FORMAT}.cache"
+    for filename in os.listdir(path):
+        if filename.startswith("__jinja2_") and not filename.endswith(suffix):
+            os.remove(os.path.join(path, filename))
+    return FileSystemBytecodeCache(path, "__jinja2_%s" + suffix)
+
+
+def make_version(*settings):
+    # anything that influences the cached values, e.g. the site config and
+    # the markdown extensions, a different version empties the cache
+    return hashlib.sha1(repr((CACHE_FORMAT,) + settings).encode()).hexdigest()
+
+
+class BuildCache:
+    # persistent cache of work done on source files (parsed pages, image
+    # info), stored per section and source pathname, an entry is only valid
+    # for the exact mtime and size the source had when it was cached
+    def __init__(self, cachepath, version):
+        self.cachepath = cachepath
+        self.pathname = os.path.join(cachepath, "build.sqlite")
+        self.version = version
+        self.connection = None
+        self.pid = None
+        self.updates = {}
+        self.hits = {}  # section as key, [hits, misses] as value
+
+    def open(self):
+        # connections can't be shared with forked processes, so every
+        # process opens its own
+        if self.connection and self.pid == os.getpid():
+            return
+        os.makedirs(self.cachepath, exist_ok=True)
+        self.connection = sqlite3.connect(self.pathname, timeout=60)
+        self.pid = os.getpid()
+        self.updates = {}
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries"
+                " (section TEXT, pathname TEXT, stamp TEXT, value BLOB,"
+                " PRIMARY KEY (section, pathname))"
+            )
+            row = self.connection.execute(
+                "SELECT value FROM meta WHERE key = 'version'"
+            ).fetchone()
+            if not row or row[0] != self.version:
+                self.connection.execute("DELETE FROM entries")
+                self.connection.execute(
+                    "REPLACE INTO meta (key, value) VALUES ('version', ?)",
+                    (self.version,),
+                )
+
+    def close(self):
+        if not self.connection or self.pid != os.getpid():
+            return
+        self.flush()
+        self.connection.close()
+        self.connection = None
+
+    def flush(self):
+        with self.connection:
+            self.connection.executemany(
+                "REPLACE INTO entries (section, pathname, stamp, value)"
+                " VALUES (?, ?, ?, ?)",
+                [
+                    (section, pathname, stamp, pickle.dumps(value))
+                    for (section, pathname), (stamp, value) in self.updates.items()
+                ],
+            )
+        self.updates = {}
+
+    def stamp(self, pathname):
+        # take the stamp before reading the source, so a change while reading
+        # doesn't end up in the cache as up to date
+        return make_stamp(os.stat(pathname))
+
+    def get(self, section, pathname, stamp):
+        value = self.lookup(section, pathname, stamp)
+        hits = self.hits.setdefault(section, [0, 0])
+        if value is None:
+            hits[1] += 1
+        else:
+            hits[0] += 1
+        return value
+
+    def lookup(self, section, pathname, stamp):
+        self.open()
+        if (section, pathname) in self.updates:
+            cachedstamp, value = self.updates[(section, pathname)]
+            return value if cachedstamp == stamp else None
+        row = self.connection.execute(
+            "SELECT stamp, value FROM entries WHERE section = ? AND pathname = ?",
+            (section, pathname),
+        ).fetchone()
+        if not row or row[0] != stamp:
+            return None
+        return pickle.loads(row[1])
+
+    def set(self, section, pathname, stamp, value):
+        self.open()
+        self.updates[(section, pathname)] = (stamp, value)
+        if len(self.updates) >= FLUSH_SIZE:
+            self.flush()  # don't keep a whole site in memory
@@ -0,0 +1,52 @@
+import os
+import gzip
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, there's always gzip
+    brotli = None
+
+COMPRESSIBLE = (".html", ".css", ".js", ".svg", ".json")
+
+# content-encoding as key, sidecar suffix as value, in order of preference
+ENCODINGS = {"br": ".br", "gzip": ".gz"} if brotli else {"gzip": ".gz"}
+
+
+def compress(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data)
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def write_sidecars(pathname):
+    # runs in a thread, zlib and brotli release the gil while compressing,
+    # returns the sidecars with their status (1 changed, 2 new)
+    with open(pathname, "rb") as sourcefile:
+        data = sourcefile.read()
+    written = []
+    for encoding, suffix in ENCODINGS.items():
+        sidecar = pathname + suffix
+        status = 1 if os.path.isfile(sidecar) else 2
+        with open(sidecar, "wb") as sidecarfile:
+            sidecarfile.write(compress(data, encoding))
+        written.append((sidecar, status))
+    return written
+
+
+def accepted_encodings(header):
+    # the content-codings in an accept-encoding header, except those with q=0
+    accepted = set()
+    for coding in (header or "").split(","):
+        name, *parameters = coding.strip().split(";")
+        quality = 1.0
+        for parameter in parameters:
+            key, _, value = parameter.strip().partition("=")
+            if key == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name and quality > 0:
+            accepted.add(name.strip().lower())
+    return accepted
+
@@ -0,0 +1,96 @@
+import hashlib
+
+from jinja2 import meta
+
+
+def template_tree(jinja, loader, name):
+    # (filename, parsed template) for a template and all templates it
+    # extends, includes or imports, dynamic (variable) template names can't
+    # be followed, the loader must be one that reads the template source files
+    names = set()
+    todo = [name]
+    while todo:
+        name = todo.pop()
+        if name in names:
+            continue
+        names.add(name)
+        source, filename, uptodate = loader.get_source(jinja, name)
+        parsed = jinja.parse(source)
+        yield filename, parsed
+        for referenced in meta.find_referenced_templates(parsed):
+            if referenced:
+                todo.append(referenced)
+
+
+def template_sources(jinja, loader, name):
+    # the filenames of the template tree, and the variables it uses from the
+    # context (those of included templates, and macros, count as well)
+    filenames = set()
+    variables = set()
+    for filename, parsed in template_tree(jinja, loader, name):
+        filenames.add(filename)
+        variables.update(meta.find_undeclared_variables(parsed))
+    return frozenset(filenames), frozenset(variables)
+
+
+def menu_structure(menu, pages=False):
+    # every output gets the complete menu in its context, so any change in
+    # the menu tree itself affects all outputs, with pages the pages in it
+    # (their paths and front-matter) are part of it as well, for templates
+    # that use the menu, which may list the pages from menu.pages
+    if pages:
+        pagelist = [(page.path, repr(page.config)) for page in menu.pages]
+        pagelist = hashlib.sha1(repr(pagelist).encode("utf-8")).hexdigest()
+    else:
+        pagelist = None
+    return (
+        menu.path,
+        repr(menu.config),
+        pagelist,
+        tuple(menu_structure(item, pages) for item in menu.items),
+    )
+
+
+class Dependencies:
+    # remembers, for every generated output, the source files (markdown and
+    # templates) it was rendered from and a signature for anything else it
+    # depends on, so a set of changed paths maps to the outputs to regenerate
+    def __init__(self):
+        self.outputs = {}  # path as key, (sources, signature) as value
+        # path as key, the images the image filters read while rendering it
+        # as value, a dict with the image as key and its resizes as value
+        self.images = {}
+        self.structure = None
+
+    def needs_rendering(self, path, sources, signature, changes):
+        if path not in self.outputs:
+            return True
+        previoussources, previoussignature = self.outputs[path]
+        if previoussources != sources or previoussignature != signature:
+            return True
+        if not sources.isdisjoint(changes):
+            return True
+        return not self.images.get(path, {}).keys().isdisjoint(changes)
+
+    def image_targets(self, changes):
+        # the resizes (and their variants) made from any of the changed images
+        changes = set(changes)
+        targets = set()
+        for images in self.images.values():
+            for source, sourcetargets in images.items():
+                if source in changes:
+                    targets.update(sourcetargets)
+        return targets
+
+    def update(self, outputs, structure, images):
+        # images are those of the outputs that were rendered, the others keep
+        # theirs, returns the paths that were generated previously, but not
+        # anymore
+        removed = [path for path in self.outputs if path not in outputs]
+        self.outputs = outputs
+        self.images = {
+            path: images[path] if path in images else self.images.get(path, {})
+            for path in outputs
+        }
+        self.structure = structure
+        return removed
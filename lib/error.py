@@ -4,3 +4,7 @@ class Error:
 
     def __str__(self):
         return self.message
+
+
+class BuildInterrupted(Exception):
+    pass
@@ -1,5 +1,5 @@
 class Group:
-    def __init__(self, path, by, config, pages):
+    def __init__(self, path, by, config, pages, index):
 
         self.path = path
         self.by = by
@@ -11,17 +11,8 @@ class Group:
         groupby = group.pop(0)
         reverse = "desc" in group
 
-        groups = {}
-        for page in pages:
-            if groupby in page.config:
-                if isinstance(page.config[groupby], list):
-                    for groupvalue in page.config[groupby]:
-                        if groupvalue not in groups:
-                            groups[groupvalue] = True
-                else:
-                    if page.config[groupby] not in groups:
-                        groups[page.config[groupby]] = True
-        groups = sorted(groups.keys(), reverse=reverse)
+        found = index.groups(pages, groupby)
+        groups = sorted(found.keys(), reverse=reverse)
 
         # depend on insertion order stability
         if "by-order" in config:
@@ -38,22 +29,12 @@ class Group:
 
         # re-order pages
         if "order" in config:
-            order = config["order"].split()
-            orderby = order.pop(0)
-            reverse = "desc" in order
-            default = "!!!!!!!!" if reverse else "zzzzzzzz"
-            decorated = [
-                (page.config.get(orderby, default) + page.path, page) for page in pages
-            ]
-            decorated.sort(reverse=reverse)
-            pages = [entry[1] for entry in decorated]
+            pages = index.order(pages, config["order"])
 
-        for page in pages:
-            if groupby in page.config:
-                if isinstance(page.config[groupby], list):
-                    for groupvalue in page.config[groupby]:
-                        if groupvalue in self.groups:
-                            self.groups[groupvalue].append(page)
-                else:
-                    if page.config[groupby] in self.groups:
-                        self.groups[page.config[groupby]].append(page)
+        ranks = {index.numbers[id(page)]: rank for rank, page in enumerate(pages)}
+        for groupvalue in self.groups:
+            if groupvalue in found:
+                self.groups[groupvalue] = [
+                    index.pages[number]
+                    for number in sorted(found[groupvalue], key=ranks.__getitem__)
+                ]
@@ -1,74 +1,443 @@
-import os.path
+import os
+import json
+import stat
 import math
-from urllib.parse import quote as urlencode
+import time
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+from urllib.parse import quote as urlencode, unquote
 from PIL import Image
-from jinja2 import Markup
+from jinja2 import Markup, contextfilter
+from .workers import run_in_parallel
+from .cache import make_stamp
+from .manifest import read_manifest, write_manifest, file_digest
+
+# Image.save format per extension, and the quality when it isn't configured
+FORMATS = {
+    ".jpg": "JPEG",
+    ".jpeg": "JPEG",
+    ".png": "PNG",
+    ".gif": "GIF",
+    ".webp": "WEBP",
+    ".avif": "AVIF",
+}
+QUALITY = {"jpeg": 85, "webp": 80, "avif": 60}
+
+# extensions of the variants in other formats, next to the resizes
+VARIANT_EXTENSIONS = (".webp", ".avif")
+
+
+def rounddown(f):
+    return (int)(math.floor(f) + 0.00001)
+
+
+def supported_format(extension):
+    # avif needs a recent Pillow (or the pillow-avif-plugin)
+    Image.init()
+    return FORMATS.get(extension.lower()) in Image.SAVE
+
+
+def variant_path(filepath, imageformat):
+    # /images/hobbes@400w300h.png.webp, like the .gz sidecars, so servers can
+    # pick the variant for browsers that accept it
+    if filepath.lower().endswith("." + imageformat):
+        return filepath
+    return f"{filepath}.{imageformat}"
+
+
+def encoder_options(target, optimization):
+    # the Image.save options for the format of target, from the
+    # image-optimization settings, none at all without those settings
+    imageformat = FORMATS.get(os.path.splitext(target)[1].lower())
+    if not optimization or not imageformat:
+        return {}
+    quality = optimization["quality"].get(
+        imageformat.lower(), QUALITY.get(imageformat.lower())
+    )
+    options = {"strip-metadata": optimization["strip-metadata"]}
+    if imageformat == "JPEG":
+        options.update(quality=quality, optimize=True, progressive=True)
+    elif imageformat in ("PNG", "GIF"):
+        options.update(optimize=True)
+    elif imageformat == "WEBP":
+        options.update(quality=quality, method=6)
+    elif imageformat == "AVIF":
+        options.update(quality=quality)
+    return options
+
+
+def settings_timestamp(pathname, settings):
+    # the time the image settings last changed, resizes from before that
+    # time are generated again
+    digest = hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+    previous = read_manifest(pathname)
+    if previous.get("digest") == digest:
+        return previous["since"]
+    since = time.time() if previous or settings else 0
+    os.makedirs(os.path.dirname(pathname), exist_ok=True)
+    write_manifest(pathname, {"digest": digest, "since": since})
+    return since
+
+
+def cover_size(imgsize, width, height):
+    # the size to scale an image to, so it covers width x height
+    imgwidth, imgheight = imgsize
+    imgratio = 1.0 * imgwidth / imgheight
+    targetratio = 1.0 * width / height
+    if imgratio < targetratio:  # width bound
+        return width, rounddown((1.0 * width / imgwidth) * imgheight)
+    # height bound
+    return rounddown((1.0 * height / imgheight) * imgwidth), height
+
+
+def open_image(source, derivatives=None):
+    # decodes the original once for all of its derivatives, jpegs are decoded
+    # at 1/2, 1/4 or 1/8 scale (draft mode) when the largest derivative is
+    # still covered by that, transparent images keep their alpha channel
+    img = Image.open(source)
+    if derivatives:
+        sizes = [cover_size(img.size, d[2], d[3]) for d in derivatives]
+        img.draft(img.mode, (max(w for w, h in sizes), max(h for w, h in sizes)))
+    if img.mode in ("RGBA", "LA", "PA") or (
+        img.mode == "P" and "transparency" in img.info
+    ):
+        return img.convert("RGBA")
+    return img.convert("RGB")
+
+
+def covers(img, derivatives):
+    # a (draft) decoded image is only large enough for smaller derivatives
+    return all(
+        w <= img.width and h <= img.height
+        for w, h in (cover_size(img.size, d[2], d[3]) for d in derivatives)
+    )
+
+
+def scale_image(img, size):
+    # halve with a box filter while the image is many times too large, that
+    # is fast, and leaves the quality to the final lanczos resize
+    if img.size == size:
+        return img
+    while img.width >= size[0] * 4 and img.height >= size[1] * 4:
+        img = img.resize((img.width // 2, img.height // 2), Image.BOX)
+    return img.resize(size, Image.LANCZOS)
+
+
+def output_image(img, outputmode, target):
+    # save in the mode of the original, as far as the format allows it, the
+    # webp and avif variants are always rgb(a)
+    if target.lower().endswith(VARIANT_EXTENSIONS):
+        return img
+    if outputmode in ("1", "L") and img.mode == "RGB":
+        return img.convert("L")
+    if outputmode == "P" and img.mode == "RGB":
+        return img.convert("P", palette=Image.ADAPTIVE)
+    if img.mode == "RGBA" and target.lower().endswith((".jpg", ".jpeg")):
+        return img.convert("RGB")
+    return img
+
+
+def save_image(img, target, options):
+    # options from encoder_options, the exif data of the original goes along
+    # unless strip-metadata is set, the color profile is always kept
+    options = dict(options)
+    if "strip-metadata" in options:
+        strip = options.pop("strip-metadata")
+        for key in ("icc_profile",) if strip else ("icc_profile", "exif"):
+            if img.info.get(key):
+                options[key] = img.info[key]
+    img.save(target, **options)
+
+
+def save_derivatives(img, derivatives):
+    # a cascade from large to small, every derivative is scaled down from
+    # the one before it, instead of from the original, and then cropped to
+    # its center
+    sizes = [cover_size(img.size, d[2], d[3]) for d in derivatives]
+    scaled = img
+    for index in sorted(range(len(derivatives)), key=sizes.__getitem__, reverse=True):
+        target, outputmode, width, height, options = derivatives[index]
+        w, h = sizes[index]
+        scaled = scale_image(scaled, (w, h))
+        xoffset = rounddown((w - width) / 2.0)
+        yoffset = rounddown((h - height) / 2.0)
+        box = (xoffset, yoffset, width + xoffset, height + yoffset)
+        save_image(output_image(scaled.crop(box), outputmode, target), target, options)
+
+
+def encoded_pathname(encodecache, digest, derivative):
+    # encodes are cached by the content of the original, and the size,
+    # mode, format and encoder options of the derivative
+    target, outputmode, width, height, options = derivative
+    extension = os.path.splitext(target)[1].lower()
+    key = hashlib.sha1(
+        repr(
+            (digest, outputmode, width, height, extension, sorted(options.items()))
+        ).encode()
+    ).hexdigest()
+    return os.path.join(encodecache, key[:2], key + extension)
+
+
+def generate_derivatives(source, derivatives, encodecache=None, load=None):
+    # runs in a worker process too, the original is decoded once for all of
+    # its derivatives, and not at all if they're all in the encode cache,
+    # returns an error message or None
+    try:
+        pending = []
+        if encodecache:
+            digest = file_digest(source)
+            for derivative in derivatives:
+                encoded = encoded_pathname(encodecache, digest, derivative)
+                if os.path.isfile(encoded):
+                    shutil.copyfile(encoded, derivative[0])
+                else:
+                    pending.append((derivative, encoded))
+        else:
+            pending = [(derivative, None) for derivative in derivatives]
+        if not pending:
+            return None
+        derivatives = [derivative for derivative, encoded in pending]
+        img = load(source, derivatives) if load else open_image(source, derivatives)
+        save_derivatives(img, derivatives)
+        for (target, *_), encoded in pending:
+            if encoded:
+                os.makedirs(os.path.dirname(encoded), exist_ok=True)
+                temporary = f"{encoded}.{os.getpid()}-{threading.get_ident()}"
+                shutil.copyfile(target, temporary)
+                os.replace(temporary, encoded)
+    except Exception as e:
+        return f"image: {source} - {str(e)}"
+
+
+def parse_sizes(sizes, height=0):
+    # imageattrs(400), imageattrs(400, 300) and imageattrs(400, height=300)
+    # are one size, strings are one size each: imageattrs("400x300", "250")
+    if not any(isinstance(size, str) for size in sizes):
+        width = sizes[0]
+        if len(sizes) > 1:
+            height = sizes[1]
+        return [(width, height)]
+    parsed = []
+    for size in sizes:
+        width, _, height = str(size).partition("x")
+        parsed.append((int(width), int(height) if height else 0))
+    return parsed
+
+
+class BitmapCache:
+    # decoded originals, the least recently used ones are dropped when their
+    # total size goes over the budget (in bytes)
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.bitmaps = OrderedDict()  # source as key, (img, imgtimestamp) as value
+
+    def get(self, source, imgtimestamp):
+        if source not in self.bitmaps:
+            return None
+        img, timestamp = self.bitmaps[source]
+        if timestamp < imgtimestamp:
+            self.remove(source)
+            return None
+        self.bitmaps.move_to_end(source)
+        return img
+
+    def put(self, source, imgtimestamp, img):
+        self.remove(source)
+        size = img.width * img.height * len(img.getbands())
+        if size > self.budget:
+            return
+        self.bitmaps[source] = (img, imgtimestamp)
+        self.size += size
+        while self.size > self.budget:
+            self.remove(next(iter(self.bitmaps)))
+
+    def remove(self, source):
+        if source in self.bitmaps:
+            img, timestamp = self.bitmaps.pop(source)
+            self.size -= img.width * img.height * len(img.getbands())
+
+
+def is_outdated(target, imgtimestamp):
+    try:
+        return os.path.getmtime(target) < imgtimestamp
+    except OSError:
+        return True
+
+
+def write_lazy_images(pathname, exportpath, imagejobs):
+    # url path as key, so the dev server can look up the requested file
+    lazyimages = {}
+    for target, job in imagejobs.items():
+        path = "/" + os.path.relpath(target, exportpath).replace(os.sep, "/")
+        lazyimages[path] = (target,) + job
+    write_manifest(pathname + ".tmp", lazyimages)
+    os.replace(pathname + ".tmp", pathname)
+
+
+class LazyImages:
+    # the resized images the generation left for the dev server, they're
+    # generated when they're first requested (or requested again after the
+    # original changed), the list is read again when the build counter changes
+    def __init__(self, pathname, buildcounter, encodecache=None):
+        self.pathname = pathname
+        self.buildcounter = buildcounter
+        self.encodecache = encodecache
+        self.generation = None
+        self.jobs = {}  # url path as key
+        self.locks = {}  # target as key, a resize is generated only once
+
+    def lookup(self, urlpath):
+        # the job for the url path, if the resize is missing or outdated
+        if self.buildcounter.value != self.generation:
+            self.generation = self.buildcounter.value
+            self.jobs = read_manifest(self.pathname)
+        job = self.jobs.get(unquote(urlpath))
+        if job and is_outdated(job[0], job[2]):
+            return job
+        return None
+
+    def generate(self, job):
+        # blocking, returns an error message or None, the resize is written
+        # next to the target and then renamed, so it is never served half done
+        target, source, imgtimestamp, outputmode, width, height, options = job
+        with self.locks.setdefault(target, threading.Lock()):
+            if not is_outdated(target, imgtimestamp):
+                return None
+            folder, filename = os.path.split(target)
+            temporary = os.path.join(folder, f".{os.getpid()}-{filename}")
+            error = generate_derivatives(
+                source,
+                [(temporary, outputmode, width, height, options)],
+                self.encodecache,
+            )
+            if not error:
+                os.replace(temporary, target)
+            return error
 
 
 def make_imagefilters(millionpages):
 
     basepath = millionpages.exportpath
-    image_cache = {}
+    image_infos = {}  # source as key, (stamp, imginfo) as value
+    image_cache = BitmapCache(
+        millionpages.siteconfig.get("image-cache-size", 256) * 1024 * 1024
+    )
+
+    def load_image(source, imgtimestamp, derivatives):
+        img = image_cache.get(source, imgtimestamp)
+        if not img or not covers(img, derivatives):
+            img = open_image(source, derivatives)
+            image_cache.put(source, imgtimestamp, img)
+        return img
 
-    def rounddown(f):
-        return (int)(math.floor(f) + 0.00001)
+    def image_info(source):
+        # (width, height, mode, mtime) of the original, or None if it isn't
+        # there, the header is only read for versions of the file that this
+        # process and the build cache haven't seen before, the image itself
+        # is only decoded to generate a resize, the output that is rendered
+        # depends on the image
+        millionpages.imagesread.setdefault(source, set())
+        try:
+            sourcestat = os.stat(source)
+        except OSError:
+            return None
+        if not stat.S_ISREG(sourcestat.st_mode):
+            return None
+        stamp = make_stamp(sourcestat)
+        if source in image_infos and image_infos[source][0] == stamp:
+            return image_infos[source][1]
+        cache = millionpages.cache
+        imginfo = cache.get("image", source, stamp) if cache else None
+        if not imginfo:
+            with Image.open(source) as img:  # only reads the header
+                imginfo = (img.size[0], img.size[1], img.mode)
+            if cache:
+                cache.set("image", source, stamp, imginfo)
+        imginfo = imginfo + (sourcestat.st_mtime,)
+        image_infos[source] = (stamp, imginfo)
+        return imginfo
 
-    def generate_image(rgbimg, outputmode, imgtimestamp, filepath, width, height):
+    def queue_image(source, outputmode, imgtimestamp, filepath, width, height):
+        # only queue the resize, they're generated after rendering, resizes
+        # from before the image settings changed are generated again
         target = os.path.join(basepath, filepath[1:])
+        imgtimestamp = max(imgtimestamp, millionpages.imagessince)
+        millionpages.imagesread.setdefault(source, set()).add(target)
 
         if millionpages.destination_needs_writing(target, imgtimestamp):
-            img = rgbimg.copy()
-            imgwidth, imgheight = img.size
-            imgratio = 1.0 * imgwidth / imgheight
-
-            targetratio = 1.0 * width / height
-            if imgratio < targetratio:  # width bound
-                w = width
-                h = rounddown((1.0 * w / imgwidth) * imgheight)
-                yoffset = rounddown((h - height) / 2.0)
-                xoffset = 0
-                destsize = (w, h)
-            else:  # height bound
-                h = height
-                w = rounddown((1.0 * h / imgheight) * imgwidth)
-                xoffset = rounddown((w - width) / 2.0)
-                yoffset = 0
-                destsize = (w, h)
-            img.thumbnail(destsize, Image.ANTIALIAS)  # right scale
-            box = (xoffset, yoffset, width + xoffset, height + yoffset)
-            img = img.crop(box)
-
-            img.convert(outputmode)
-            img.save(target)
-
-    def generate_images(rgbimg, outputmode, imgtimestamp, srcset):
-        for entry in srcset:
-            generate_image(rgbimg, outputmode, imgtimestamp, *entry)
-
-    def imageurl(filepath, width, height=0):
+            millionpages.imagejobs[target] = (
+                source,
+                imgtimestamp,
+                outputmode,
+                width,
+                height,
+                encoder_options(target, millionpages.imageoptimization),
+            )
+
+    def generate_image(
+        source, outputmode, imgtimestamp, filepath, width, height, original=False
+    ):
+        # the resize, and its variants in the image-optimization formats, the
+        # original itself only needs the variants
+        if not original:
+            queue_image(source, outputmode, imgtimestamp, filepath, width, height)
+        optimization = millionpages.imageoptimization
+        for imageformat in optimization["formats"] if optimization else ():
+            variant = variant_path(filepath, imageformat)
+            if variant != filepath:
+                queue_image(source, outputmode, imgtimestamp, variant, width, height)
+
+    def generate_queued_images(imagejobs):
+        # returns a list of error messages
+        sources = {}
+        for target, (source, imgtimestamp, *derivative) in sorted(imagejobs.items()):
+            derivatives = sources.setdefault((source, imgtimestamp), [])
+            derivatives.append((target, *derivative))
+
+        encodecache = millionpages.encodecache
+        if millionpages.jobs > 1 and len(sources) > 1:
+            arguments = [
+                (source, derivatives, encodecache)
+                for (source, imgtimestamp), derivatives in sources.items()
+            ]
+            results = run_in_parallel(
+                generate_derivatives, arguments, millionpages.jobs
+            )
+            return [error for error in results if error]
+
+        errors = []
+        for (source, imgtimestamp), derivatives in sources.items():
+            error = generate_derivatives(
+                source,
+                derivatives,
+                encodecache,
+                lambda source, derivatives: load_image(
+                    source, imgtimestamp, derivatives
+                ),
+            )
+            if error:
+                errors.append(error)
+        return errors
+
+    # the filters take the context, so jinja never evaluates them on constant
+    # arguments while compiling, they must run at every render to queue the
+    # resized images, also when the template comes from the bytecode cache
+    @contextfilter
+    def imageurl(context, filepath, width, height=0):
         source = os.path.join(basepath, filepath[1:])
+        if isinstance(width, str):  # "400x300"
+            ((width, height),) = parse_sizes([width])
 
         safe = "/@"
-        if not os.path.isfile(source):
+        imginfo = image_info(source)
+        if not imginfo:
             return Markup(f"{urlencode(filepath, safe=safe)}")
 
-        imgtimestamp = os.path.getmtime(source)
+        imgwidth, imgheight, imgmode, imgtimestamp = imginfo
 
-        cached_imginfo = image_cache.get(filepath, (None, None))
-        if cached_imginfo and cached_imginfo[1] and cached_imginfo[1] >= imgtimestamp:
-            img = cached_imginfo[0]
-            imgmode = img.mode
-        else:
-            img = Image.open(source)
-            imgmode = img.mode
-            if img.mode == "1":
-                img = img.convert("L")
-            elif img.mode == "L":
-                pass
-            img = img.convert("RGB")
-            image_cache[filepath] = (img, imgtimestamp)
-
-        imgwidth, imgheight = img.size
         imgratio = 1.0 * imgwidth / imgheight
         if not height:
             reqratio = imgratio
@@ -85,41 +454,17 @@ def make_imagefilters(millionpages):
         srcinfo = srcsetentry(filepath, width, height)
 
         if not height:
-            generate_image(img, imgmode, imgtimestamp, *srcinfo)
+            generate_image(source, imgmode, imgtimestamp, *srcinfo)
         else:
-            generate_image(img, imgmode, imgtimestamp, *srcinfo)
+            generate_image(source, imgmode, imgtimestamp, *srcinfo)
 
         safe = "/@"
         return Markup(f"{urlencode(srcinfo[0], safe=safe)}")
 
-    def imageattrs(filepath, width, height=0):
-        source = os.path.join(basepath, filepath[1:])
-
-        if not os.path.isfile(source):
-            return Markup(f' src="{filepath}" ')
-
-        imgtimestamp = os.path.getmtime(source)
-
-        cached_imginfo = image_cache.get(filepath, (None, None))
-        if cached_imginfo and cached_imginfo[1] and cached_imginfo[1] >= imgtimestamp:
-            img = cached_imginfo[0]
-            imgmode = img.mode
-        else:
-            img = Image.open(source)
-            imgmode = img.mode
-            if img.mode == "1":
-                img = img.convert("L")
-            elif img.mode == "L":
-                pass
-            img = img.convert("RGB")
-            image_cache[filepath] = (img, imgtimestamp)
-
-        imgwidth, imgheight = img.size
+    def srcset_for(filepath, imgwidth, imgheight, width, height):
+        # the srcset entries (path, width, height) for one size, @1x, @2x and
+        # @3x up to the size of the original, the last one is the src
         imgratio = 1.0 * imgwidth / imgheight
-        if not height:
-            reqratio = imgratio
-        else:
-            reqratio = width / height
 
         def srcsetentry(filepath, width, height=0):
             if not height:
@@ -138,11 +483,9 @@ def make_imagefilters(millionpages):
                 )
 
         if not height:
-            generate_images(
-                img, imgmode, imgtimestamp, srcset
-            )  # no need to generate original
-            srcset.append((filepath, imgwidth, imgheight))
+            srcset.append((filepath, imgwidth, imgheight))  # the original
         else:
+            reqratio = width / height
             if imgratio > reqratio:  # image wider than requested, so crop width
                 srcwidth = rounddown(reqratio * imgheight)
                 srcheight = imgheight
@@ -150,16 +493,67 @@ def make_imagefilters(millionpages):
                 srcwidth = imgwidth
                 srcheight = rounddown(imgwidth / reqratio)
             srcset.append(srcsetentry(filepath, srcwidth, srcheight))
-            generate_images(img, imgmode, imgtimestamp, srcset)
+        return srcset
+
+    @contextfilter
+    def imageattrs(context, filepath, *sizes, height=0, format=None):
+        source = os.path.join(basepath, filepath[1:])
+
+        imginfo = image_info(source)
+        if not imginfo:
+            return Markup(f' src="{filepath}" ')
 
-        src = srcset[-1]
+        imgwidth, imgheight, imgmode, imgtimestamp = imginfo
+
+        srcsets = [
+            srcset_for(filepath, imgwidth, imgheight, width, height)
+            for width, height in parse_sizes(sizes, height)
+        ]
+        # a srcset can have only one entry per width, the first size wins
+        srcset = {}
+        for entries in srcsets:
+            for entry in entries:
+                srcset.setdefault(entry[1], entry)
+        entries = list(srcset.values())
+        if len(srcsets) > 1:
+            entries.sort(key=lambda entry: entry[1])
 
         safe = "/@"
+        if format:
+            # the attributes for a <source> element in a <picture> element,
+            # nothing if this Pillow can't write the format
+            imageformat = format.lower()
+            if not supported_format("." + imageformat):
+                return Markup("")
+            entries = [
+                (variant_path(path, imageformat), w, h) for path, w, h in entries
+            ]
+            for entry in entries:
+                if entry[0] != filepath:
+                    queue_image(source, imgmode, imgtimestamp, *entry)
+            srcsetentries = ", ".join(
+                [f"{urlencode(src[0], safe=safe)} {src[1]}w" for src in entries]
+            )
+            mimetype = Image.MIME[FORMATS["." + imageformat]]
+            return Markup(f' srcset="{srcsetentries}" type="{mimetype}" ')
+
+        for entry in entries:
+            # the original is there already, but may need its variants
+            generate_image(
+                source, imgmode, imgtimestamp, *entry, original=entry[0] == filepath
+            )
+
+        src = srcsets[0][-1]
+
         srcsetentries = ", ".join(
-            [f"{urlencode(src[0], safe=safe)} {src[1]}w" for src in srcset]
+            [f"{urlencode(src[0], safe=safe)} {src[1]}w" for src in entries]
         )
         return Markup(
             f' src="{urlencode(src[0], safe=safe)}" srcset="{srcsetentries}" '
         )
 
-    return {"imageurl": imageurl, "imageattrs": imageattrs}
+    return {
+        "imageurl": imageurl,
+        "imageattrs": imageattrs,
+        "generate": generate_queued_images,
+    }
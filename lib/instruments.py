@@ -0,0 +1,83 @@
+import sys
+import time
+import heapq
+from contextlib import contextmanager
+
+
+class Instruments:
+    # the number of calls and the time spent per kind (templates, filters,
+    # ...) and name, and the slowest outputs, for the build report, workers
+    # send theirs back to be merged with the generation's
+    def __init__(self, slowest=20):
+        self.counters = {}  # kind as key, {name: [calls, seconds]} as value
+        self.slowest = []  # heap of (seconds, path), the fastest on top
+        self.slowestsize = slowest
+
+    @contextmanager
+    def measure(self, kind, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(kind, name, 1, time.perf_counter() - start)
+
+    def add(self, kind, name, calls, seconds):
+        counter = self.counters.setdefault(kind, {}).setdefault(name, [0, 0.0])
+        counter[0] += calls
+        counter[1] += seconds
+
+    def add_output(self, path, seconds):
+        if len(self.slowest) < self.slowestsize:
+            heapq.heappush(self.slowest, (seconds, path))
+        else:
+            heapq.heappushpop(self.slowest, (seconds, path))
+
+    def merge(self, other):
+        for kind, counters in other.counters.items():
+            for name, (calls, seconds) in counters.items():
+                self.add(kind, name, calls, seconds)
+        for seconds, path in other.slowest:
+            self.add_output(path, seconds)
+
+    def report(self):
+        report = {
+            kind: {
+                name: {"calls": calls, "seconds": round(seconds, 6)}
+                for name, (calls, seconds) in sorted(counters.items())
+            }
+            for kind, counters in sorted(self.counters.items())
+        }
+        report["slowest"] = [
+            {"path": path, "seconds": round(seconds, 6)}
+            for seconds, path in sorted(self.slowest, reverse=True)
+        ]
+        return report
+
+
+class Progress:
+    # a status line with counts, redrawn at most every interval seconds, and
+    # only on a terminal, printing for every single page is too slow
+    def __init__(self, interval=0.2, stream=None):
+        self.interval = interval
+        self.stream = stream or sys.stdout
+        self.enabled = self.stream.isatty()
+        self.counts = {}
+        self.shown = 0
+
+    def add(self, kind, count=1):
+        self.counts[kind] = self.counts.get(kind, 0) + count
+        if self.enabled and time.monotonic() - self.shown >= self.interval:
+            self.show()
+
+    def show(self):
+        line = ", ".join(f"{count} {kind}" for kind, count in self.counts.items())
+        self.stream.write("\r" + line)
+        self.stream.flush()
+        self.shown = time.monotonic()
+
+    def done(self):
+        if self.enabled and self.counts:
+            self.show()
+            self.stream.write("\n")
+        self.counts = {}
+        self.shown = 0
@@ -0,0 +1,57 @@
+import os
+
+LIVERELOAD_PATH = "/_livereload"
+
+# reloads the page when its own output, or a stylesheet, script or image it
+# uses, is in the list of url paths a build sends over the websocket
+SCRIPT = """<script>
+(function () {
+  function normalize(path) {
+    return path.replace(/\\/index\\.html$/, "").replace(/\\/$/, "") || "/";
+  }
+  function connect() {
+    var scheme = location.protocol === "https:" ? "wss://" : "ws://";
+    var socket = new WebSocket(scheme + location.host + "%s");
+    socket.onmessage = function (event) {
+      var changed = JSON.parse(event.data).map(normalize);
+      var used = [normalize(location.pathname)];
+      var elements = document.querySelectorAll(
+        "link[href], script[src], img[src], source[src], video[src], audio[src]"
+      );
+      elements.forEach(function (element) {
+        var url = new URL(element.getAttribute("href") || element.getAttribute("src"), location.href);
+        if (url.host === location.host) used.push(normalize(url.pathname));
+      });
+      if (used.some(function (path) { return changed.indexOf(path) >= 0; })) {
+        location.reload();
+      }
+    };
+    socket.onclose = function () {
+      setTimeout(connect, 2000);
+    };
+  }
+  connect();
+})();
+</script>
+""" % (
+    LIVERELOAD_PATH
+)
+
+
+def inject_script(html):
+    # the script goes right before the closing body tag, or at the end
+    position = html.lower().rfind("</body>")
+    if position < 0:
+        return html + SCRIPT
+    return html[:position] + SCRIPT + html[position:]
+
+
+def output_urls(exportpath, destinations):
+    # the url paths for generated files, a page is served for its folder
+    urls = set()
+    for destination in destinations:
+        path = "/" + os.path.relpath(destination, exportpath).replace(os.sep, "/")
+        if path.endswith("/index.html"):
+            path = path[: -len("/index.html")] or "/"
+        urls.add(path)
+    return sorted(urls)
@@ -0,0 +1,62 @@
+import os
+import json
+import hashlib
+
+
+def file_digest(pathname):
+    sha1 = hashlib.sha1()
+    with open(pathname, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def read_manifest(pathname):
+    try:
+        with open(pathname, "r") as manifestfile:
+            return json.load(manifestfile)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_manifest(pathname, manifest):
+    with open(pathname, "w") as manifestfile:
+        json.dump(manifest, manifestfile, indent=1, sort_keys=True)
+
+
+def make_manifest(exportpath, output, previous):
+    # path in the generated site as key, size, mtime and content hash as
+    # value, files that didn't change keep the hash from the previous manifest
+    manifest = {}
+    for destination, status in output.items():
+        try:
+            stat = os.stat(destination)
+        except FileNotFoundError:
+            continue
+        path = "/" + os.path.relpath(destination, exportpath).replace(os.sep, "/")
+        entry = previous.get(path)
+        if (
+            status != 0
+            or not entry
+            or entry["size"] != stat.st_size
+            or entry["mtime"] != stat.st_mtime_ns
+        ):
+            entry = {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime_ns,
+                "sha1": file_digest(destination),
+            }
+        manifest[path] = entry
+    return manifest
+
+
+def compare_manifests(previous, manifest):
+    return {
+        "added": sorted(path for path in manifest if path not in previous),
+        "changed": sorted(
+            path
+            for path in manifest
+            if path in previous and previous[path]["sha1"] != manifest[path]["sha1"]
+        ),
+        "deleted": sorted(path for path in previous if path not in manifest),
+    }
@@ -1,3 +1,4 @@
+import math
 from .tools import parse
 from .error import Error
 
@@ -45,3 +46,39 @@ class Menu:
 
     def set_pages(self, pages):
         self.pages = pages
+
+    def paginate(self):
+        # index pages for this menu, one unless paginated with `paginate: N`
+        # in the pages config (or directly in a group config)
+        if self._is_group:
+            perpage = self.config.get("paginate")
+        else:
+            perpage = self.config.get("pages", {}).get("paginate")
+        if not perpage:
+            return [Pagination(self, 1, 1, self.pages)]
+        count = max(1, math.ceil(len(self.pages) / perpage))
+        return [
+            Pagination(
+                self, number, count, self.pages[(number - 1) * perpage : number * perpage]
+            )
+            for number in range(1, count + 1)
+        ]
+
+
+def pagination_path(path, number):
+    # /path, /path/page/2, /path/page/3, ...
+    if number == 1:
+        return path
+    return ("" if path == "/" else path) + f"/page/{number}"
+
+
+class Pagination:
+    def __init__(self, menu, number, count, pages):
+        self.menu = menu
+        self.number = number
+        self.count = count
+        self.pages = pages
+        self.path = pagination_path(menu.path, number)
+        self.paths = [pagination_path(menu.path, n) for n in range(1, count + 1)]
+        self.previous = self.paths[number - 2] if number > 1 else ""
+        self.next = self.paths[number] if number < count else ""
@@ -1,17 +1,63 @@
 import os
+import copy
+import json
 import time
-import shutil
-from jinja2 import Environment, FileSystemLoader, select_autoescape
-from .page import make_page
+import hashlib
+import functools
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from jinja2 import (
+    Environment,
+    FileSystemLoader,
+    ChoiceLoader,
+    ModuleLoader,
+    select_autoescape,
+    meta,
+    contextfilter,
+)
+from .page import make_page, make_lazy_page, PageReader
 from .menu import make_menu, Menu
-from .error import Error
+from .error import Error, BuildInterrupted
 from .group import Group
-from .imagetools import make_imagefilters
+from .pageindex import PageIndex
+from .imagetools import (
+    make_imagefilters,
+    write_lazy_images,
+    supported_format,
+    settings_timestamp,
+)
+from .cache import BuildCache, make_version, make_stamp, make_bytecode_cache
+from .dependencies import Dependencies, template_sources, menu_structure
+from .workers import render_in_parallel
+from .mirror import make_mirror
+from .manifest import (
+    read_manifest,
+    write_manifest,
+    make_manifest,
+    compare_manifests,
+    file_digest,
+)
+from .search import SearchIndex, tokenize
+from .compress import COMPRESSIBLE, ENCODINGS, write_sidecars
+from .instruments import Instruments, Progress
+from .outputs import OutputStatuses
+from .bundle import make_bundle
 
 
 class MillionPages:
     def __init__(
-        self, siteconfig, title, sitepath, themepath, templatesfolder, exportpath
+        self,
+        siteconfig,
+        title,
+        sitepath,
+        themepath,
+        templatesfolder,
+        exportpath,
+        cachepath=None,
+        jobs=1,
+        precompiledpath=None,
+        lowmemory=False,
+        lazyimages=False,
     ):
         self.siteconfig = siteconfig
         self.title = title
@@ -19,47 +65,285 @@ class MillionPages:
         self.themepath = themepath
         self.templatesfolder = templatesfolder
         self.exportpath = exportpath
+        self.jobs = jobs
+        # in low-memory mode pages only keep their front-matter, the content
+        # is read (from the cache) when it is rendered, and then forgotten
+        self.lowmemory = lowmemory
+        self.instruments = Instruments()
+        self.progress = Progress()
+        self.read_page = self.measured("tasks", "read page", self.make_page)
+        self.mirror = self.measured(
+            "tasks", "copy file", make_mirror(siteconfig.get("asset-mirroring", "copy"))
+        )
+        self.markdownconfig = {
+            "extensions": siteconfig.get("markdown-extensions", []),
+            "extension_configs": siteconfig.get("markdown-extension-configs", {}),
+        }
+        self.cache = None
+        if cachepath:
+            self.cache = BuildCache(
+                cachepath, make_version(siteconfig, self.markdownconfig)
+            )
+        self.reader = PageReader(self.markdownconfig, self.cache)
         self.errors = []
         self.pages = {}  # path as key
         self.menu = {}
+        self.menufiles = {}  # path as key
         self.menucount = 0
-        self.output = {}
+        self.pageindex = None
+        self.output = self.make_output()
+        self.plan = {}  # path as key
+        self.dependencies = Dependencies()
+        self.imagejobs = {}  # target as key
+        # the images read by the image filters while rendering an output,
+        # image as key, the resizes it queued as value
+        self.imagesread = {}
+        # quality and metadata settings per format, and the formats for the
+        # variants next to every resize, encodes are cached by the content of
+        # the original and the settings, so they're never done twice
+        self.imageoptimization = None
+        self.encodecache = None
+        optimization = siteconfig.get("image-optimization")
+        if optimization:
+            if not isinstance(optimization, dict):
+                optimization = {}
+            self.imageoptimization = {
+                "quality": optimization.get("quality", {}),
+                "strip-metadata": optimization.get("strip-metadata", True),
+                "formats": [
+                    imageformat
+                    for imageformat in optimization.get("formats", [])
+                    if supported_format("." + imageformat)
+                ],
+            }
+            if cachepath:
+                self.encodecache = os.path.join(cachepath, "images")
+        self.imagessince = 0  # resizes from before are generated again
+        if cachepath:
+            self.imagessince = settings_timestamp(
+                os.path.join(cachepath, "image-settings.json"), self.imageoptimization
+            )
+        # for the dev server, resized images are only listed, and generated
+        # when they're first requested, the build generates them all
+        self.lazyimages = {} if lazyimages else None  # target as key
+        self.contenttemplates = {}  # content hash as key
+        self.uploadchanges = None
+        self.timings = {}  # phase as key, seconds as value, for the last go
+        self.interrupted = lambda: False
+        self.resumed = False  # the last generation was interrupted
+        self.precompress = None  # minimum size of the outputs to compress
+        if siteconfig.get("precompress"):
+            precompress = siteconfig["precompress"]
+            if not isinstance(precompress, dict):
+                precompress = {}
+            self.precompress = precompress.get("min-size", 1024)
+        self.sidecars = set()
+        # theme and site files with these extensions get a copy named after
+        # their content (style/site.0123456789.css), the asset() function in
+        # the templates gives its url, so it can be cached forever
+        self.fingerprint = None
+        if siteconfig.get("fingerprint"):
+            fingerprint = siteconfig["fingerprint"]
+            if not isinstance(fingerprint, dict):
+                fingerprint = {}
+            self.fingerprint = tuple(
+                extension.lower()
+                for extension in fingerprint.get("extensions", [".css", ".js"])
+            )
+        self.assets = {}  # url path as key, fingerprinted url path as value
+        # the _*.js and _*.css files in a theme folder are bundled into its
+        # _index.js and _index.css
+        bundle = siteconfig.get("bundle")
+        if not isinstance(bundle, dict):
+            bundle = {}
+        self.bundleconfig = {
+            "minify": bundle.get("minify", True),
+            "source-maps": bundle.get("source-maps", False),
+        }
+        self.search = None
+        searchconfig = siteconfig.get("search")
+        if searchconfig:
+            if not isinstance(searchconfig, dict):
+                searchconfig = {}
+            self.search = SearchIndex(
+                searchconfig.get("shard-size", 20000),
+                self.cache.get("search", "", "ids") if self.cache else None,
+            )
+        # compiled templates are kept in the cache, their source is checked
+        # so changed templates are compiled again, precompiled templates are
+        # used as is, they're meant for builds where the theme doesn't change
+        self.themeloader = FileSystemLoader(os.path.join(self.themepath))
+        loader = self.themeloader
+        if precompiledpath:
+            loader = ChoiceLoader([ModuleLoader(precompiledpath), self.themeloader])
+        bytecodecache = None
+        if cachepath:
+            bytecodecache = make_bytecode_cache(os.path.join(cachepath, "templates"))
         self.jinja = Environment(
-            loader=FileSystemLoader(os.path.join(self.themepath)),
+            loader=loader,
+            bytecode_cache=bytecodecache,
             autoescape=select_autoescape(["html"]),
             trim_blocks=True,
             lstrip_blocks=True,
         )
         imagefilters = make_imagefilters(self)
-        self.jinja.filters["imageurl"] = imagefilters["imageurl"]
-        self.jinja.filters["imageattrs"] = imagefilters["imageattrs"]
+        for name in ("imageurl", "imageattrs"):
+            filter = self.measured("filters", name, imagefilters[name])
+            self.jinja.filters[name] = filter
+        self.generate_queued_images = imagefilters["generate"]
+        self.jinja.globals["asset"] = self.asset_url
+        # a context filter, so jinja never compiles it to a constant, the
+        # fingerprints change without the templates changing
+        self.jinja.filters["asset"] = contextfilter(
+            lambda context, path: self.asset_url(path)
+        )
 
-    def go(self):
+    def go(self, changes=None, interrupted=None):
+        # changes is a set of changed paths in the site and theme folders,
+        # without it (or when the changes can't be handled incrementally) the
+        # complete site is generated, when interrupted() turns True before
+        # the pages are all rendered, the generation stops and go returns
+        # False, the next generation has to include the same changes
+        self.interrupted = interrupted or (lambda: False)
+        self.timings = {}
+        self.instruments = Instruments()
+        if self.cache:
+            self.cache.hits = {}
+        start = time.perf_counter()
+        complete = False
         try:
-            self.reset_generation()
+            if changes is None or not self.update_generation(changes):
+                complete = True
+                self.reset_generation()
 
-            self.process_theme_folder()
-            self.process_site_folder()
+                with self.phase("theme"):
+                    self.process_theme_folder()
+                with self.phase("site"):
+                    self.process_site_folder()
+                self.check_interrupted()
 
-            self.build_menu(self.menu, self.pages.values())
+                with self.phase("menu"):
+                    self.pageindex = PageIndex(self.pages.values())
+                    self.build_menu(self.menu, self.pages.values())
+                self.check_interrupted()
 
-            self.generate_site()
+                with self.phase("generate"):
+                    self.generate_site()
+                with self.phase("search"):
+                    self.generate_search_index()
+                with self.phase("compress"):
+                    self.compress_output()
 
-            self.cleanup_generated_site()
+                with self.phase("cleanup"):
+                    self.cleanup_generated_site()
+
+            with self.phase("manifest"):
+                self.write_upload_manifest()
+                if self.fingerprint:
+                    write_manifest(self.exportpath + ".assets.json", self.assets)
 
             self.print_report()
+            self.write_build_report(time.perf_counter() - start)
+            self.resumed = False
+        except BuildInterrupted:
+            if complete:
+                self.plan = {}  # start over with a complete generation
+            self.resumed = True
+            print()
+            print("Interrupted by new changes, starting again.")
+            return False
         except Exception as e:
+            self.plan = {}  # the next generation can't build on this one
+            self.errors.append(str(e))
             print()
             print(str(e))
             print(
                 "Error in building site. Once the error is corrected you can save again to trigger a rebuild."
             )
+        finally:
+            self.interrupted = lambda: False
+            if self.cache:
+                self.cache.close()
+        return True
+
+    def write_build_report(self, seconds):
+        # the report of the last generation, as json, next to the manifest
+        statuses = list(self.output.values())
+        report = {
+            "seconds": round(seconds, 6),
+            "pages": len(self.pages),
+            "indices": self.menucount,
+            "outputs": {
+                "new": statuses.count(2),
+                "changed": statuses.count(1),
+                "unchanged": statuses.count(0),
+            },
+            "errors": self.errors,
+            "phases": {name: round(secs, 6) for name, secs in self.timings.items()},
+            "cache": {},
+        }
+        report.update(self.instruments.report())
+        if self.cache:
+            for section, (hits, misses) in sorted(self.cache.hits.items()):
+                ratio = round(hits / (hits + misses), 4) if hits + misses else None
+                report["cache"][section] = {
+                    "hits": hits,
+                    "misses": misses,
+                    "ratio": ratio,
+                }
+        write_manifest(self.exportpath + ".report.json", report)
+
+    def make_output(self):
+        # destination as key, status (0 unchanged, 1 changed, 2 new) as value
+        if self.lowmemory:
+            return OutputStatuses(self.exportpath)
+        return {}
+
+    def make_page(self, key, pathname):
+        if self.lowmemory:
+            return make_lazy_page(key, pathname, self.reader)
+        return make_page(key, pathname, self.markdownconfig, self.cache)
+
+    def measured(self, kind, name, function):
+        # function, with its calls and time added to the instruments
+        @functools.wraps(function)
+        def measuredfunction(*args, **kwargs):
+            with self.instruments.measure(kind, name):
+                return function(*args, **kwargs)
+
+        return measuredfunction
+
+    @contextmanager
+    def phase(self, name):
+        # adds the time spent in the block to the timings of the phase
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = (
+                self.timings.get(name, 0) + time.perf_counter() - start
+            )
+
+    def check_interrupted(self):
+        if self.interrupted():
+            raise BuildInterrupted()
 
     def print_report(self):
         print()
         print(f"Pages  : {len(self.pages):4}")
         print(f"Indices: {self.menucount:4}")
-        print(f"Output : {len(self.output):4}")
+        statuses = list(self.output.values())
+        print(
+            f"Output : {len(self.output):4}"
+            f" ({statuses.count(2)} new, {statuses.count(1)} changed,"
+            f" {statuses.count(0)} unchanged)"
+        )
+        if self.uploadchanges:
+            print(
+                f"Upload : {len(self.uploadchanges['added'])} added,"
+                f" {len(self.uploadchanges['changed'])} changed,"
+                f" {len(self.uploadchanges['deleted'])} deleted"
+            )
         if self.errors:
             print(f"Errors : {len(self.errors):4}")
             for error in self.errors:
@@ -76,11 +360,107 @@ class MillionPages:
         os.makedirs(self.exportpath, exist_ok=True)
         self.errors = []
         self.pages = {}
+        self.assets = {}
         self.menu = {}
+        self.menufiles = {}
         self.menucount = 0
-        self.output = {}
+        self.output = self.make_output()
+        self.plan = {}
+        self.dependencies = Dependencies()
+        self.contenttemplates = {}
         self.starttime = time.time()
 
+    def update_generation(self, changes):
+        # regenerate only what is affected by the changed paths, returns
+        # False if a complete generation is needed instead
+        if not self.plan:
+            return False
+
+        templatespath = os.path.join(self.themepath, self.templatesfolder)
+        changedpages = {}  # page key as key, pathname as value
+        changedstatics = {}  # pathname as key, destination as value
+        changedbundles = set()  # theme folders, relative
+        for pathname in changes:
+            if pathname.startswith(templatespath + os.sep):
+                if not os.path.isfile(pathname):
+                    return False  # templates can't be resolved anymore
+                continue  # all outputs record the templates they use
+            if pathname.startswith(self.themepath + os.sep):
+                folderpath = self.themepath
+            elif pathname.startswith(self.sitepath + os.sep):
+                folderpath = self.sitepath
+            else:
+                continue
+            relpath = os.path.relpath(pathname, folderpath)
+            parts = relpath.split(os.sep)
+            f = parts[-1]
+            if any(part.startswith("_") for part in parts[:-1]):
+                continue
+            if os.path.isdir(pathname):
+                return False  # folder added, or moved into place
+            if folderpath == self.sitepath:
+                if f == "__index__.yaml":
+                    return False  # menu configuration changed
+                if f in ("__index__.md", "__index__.markdown") or (
+                    not f.startswith("_") and f.endswith((".md", ".markdown"))
+                ):
+                    path = os.path.dirname(relpath)
+                    key = os.path.join("/" + path if path else "", f)
+                    changedpages[key] = pathname
+                    continue
+            if f.startswith("_"):
+                if folderpath == self.themepath and f.endswith((".js", ".css")):
+                    changedbundles.add(os.path.dirname(relpath))
+                continue
+            destination = os.path.join(self.exportpath, relpath)
+            if not os.path.exists(pathname) and destination not in self.output:
+                folder = destination + os.sep
+                if any(output.startswith(folder) for output in self.output):
+                    return False  # folder removed, or moved away
+                continue  # never generated, e.g. an editor's temporary file
+            changedstatics[pathname] = destination
+
+        self.errors = []
+        self.starttime = time.time()
+        if not self.resumed:  # keep what the interrupted generation wrote
+            for destination in self.output:
+                self.output[destination] = 0
+
+        with self.phase("site"):
+            for source, destination in changedstatics.items():
+                if os.path.isfile(source):
+                    sourcetimestamp = os.path.getmtime(source)
+                    if self.destination_needs_writing(destination, sourcetimestamp):
+                        os.makedirs(os.path.dirname(destination), exist_ok=True)
+                        self.mirror(source, destination)
+                else:
+                    self.remove_output(destination)
+                self.fingerprint_file(source, destination)
+            for path in changedbundles:
+                self.bundle_theme_folder(path)
+
+            for key, pathname in changedpages.items():
+                if os.path.isfile(pathname):
+                    page = self.read_page(key, pathname)
+                    page.canonical = self.siteconfig["domain"] + page.path
+                    self.pages[key] = page
+                else:
+                    self.pages.pop(key, None)
+        if changedpages:
+            with self.phase("menu"):
+                self.assemble_menu()
+                self.pageindex = PageIndex(self.pages.values())
+                self.build_menu(self.menu, self.pages.values())
+
+        with self.phase("generate"):
+            # the image filters read the mirrored copies of the images
+            self.generate_site(set(changes).union(changedstatics.values()))
+        with self.phase("search"):
+            self.generate_search_index()
+        with self.phase("compress"):
+            self.compress_output()
+        return True
+
     def cleanup_generated_site(self):
         # walk the upload-folder, compare with self.output
         # if not in self.output, remove
@@ -97,25 +477,123 @@ class MillionPages:
                 except OSError:
                     pass  # not empty, don't remove
 
+    def remove_output(self, destination):
+        self.output.pop(destination, None)
+        try:
+            os.remove(destination)
+        except FileNotFoundError:
+            pass
+        # also clean up the folders it leaves empty
+        folder = os.path.dirname(destination)
+        while folder.startswith(self.exportpath + os.sep):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                break  # not empty, don't remove
+            folder = os.path.dirname(folder)
+
+    def write_upload_manifest(self):
+        # the manifest lists every file in the generated site, the changes
+        # compare it with the manifest of the last upload (when the upload
+        # step saved it as .uploaded.json) or else with the previous
+        # generation, so an upload only has to transfer the changes
+        manifestpath = self.exportpath + ".manifest.json"
+        uploadedpath = self.exportpath + ".uploaded.json"
+        previous = read_manifest(manifestpath)
+        manifest = make_manifest(self.exportpath, self.output, previous)
+        if os.path.isfile(uploadedpath):
+            previous = read_manifest(uploadedpath)
+        self.uploadchanges = compare_manifests(previous, manifest)
+        write_manifest(manifestpath, manifest)
+        write_manifest(self.exportpath + ".changes.json", self.uploadchanges)
+
+    def compress_output(self):
+        # .gz (and .br) sidecars next to the text outputs, for servers that
+        # serve those as is, only changed outputs are compressed again
+        if self.precompress is None:
+            return
+        sidecars = set()
+        compress = []
+        for destination, status in list(self.output.items()):
+            if not destination.endswith(COMPRESSIBLE):
+                continue
+            if os.path.getsize(destination) < self.precompress:
+                continue
+            outputsidecars = [destination + suffix for suffix in ENCODINGS.values()]
+            sidecars.update(outputsidecars)
+            if status or not all(map(os.path.isfile, outputsidecars)):
+                compress.append(destination)
+            else:
+                for sidecar in outputsidecars:
+                    self.set_status(sidecar, 0)
+        if compress:
+            with ThreadPoolExecutor() as executor:
+                for written in executor.map(write_sidecars, compress):
+                    for sidecar, status in written:
+                        self.set_status(sidecar, status)
+        # sidecars of outputs that are removed, or too small now
+        for sidecar in self.sidecars - sidecars:
+            if sidecar in self.output:
+                self.remove_output(sidecar)
+        self.sidecars = sidecars
+
+    def set_status(self, destination, status):
+        # a generation that resumes an interrupted one never lowers a status,
+        # what the interrupted one wrote is still new or changed
+        if self.resumed:
+            status = max(status, self.output.get(destination, 0))
+        self.output[destination] = status
+
     def destination_needs_writing(self, destination, last_modified):
         if not os.path.isfile(destination):
-            self.output[destination] = 2
+            self.set_status(destination, 2)
             return True
         destinationtimestamp = os.path.getmtime(destination)
         if destinationtimestamp < last_modified:
-            self.output[destination] = 1
+            self.set_status(destination, 1)
             return True
-        self.output[destination] = 0
+        self.set_status(destination, 0)
         return False
 
+    def write_output(self, destination, content):
+        with self.instruments.measure("tasks", "write output"):
+            return self.write_content(destination, content)
+
+    def write_content(self, destination, content):
+        # only write when the content differs from what is there, which is
+        # known from the hash stored when it was written (as long as the file
+        # wasn't touched since), or else from the file itself
+        data = content.encode("utf-8")
+        digest = hashlib.sha1(data).hexdigest()
+        try:
+            stamp = make_stamp(os.stat(destination))
+        except FileNotFoundError:
+            stamp = None
+        if stamp:
+            writtendigest = None
+            if self.cache:
+                writtendigest = self.cache.get("output", destination, stamp)
+            if not writtendigest:
+                with open(destination, "rb") as outputfile:
+                    writtendigest = hashlib.sha1(outputfile.read()).hexdigest()
+            if writtendigest == digest:
+                self.set_status(destination, 0)
+                return False
+        with open(destination, "wb") as outputfile:
+            outputfile.write(data)
+        self.set_status(destination, 1 if stamp else 2)
+        if self.cache:
+            self.cache.set("output", destination, self.cache.stamp(destination), digest)
+        return True
+
     def process_theme_folder(self):
         # skip _ files and folders
         # copy rest to export folder
         for root, dirs, files in os.walk(self.themepath):
             path = root[len(self.themepath) :]
-            for skipdir in filter(lambda d: d.startswith("_"), dirs):
+            for skipdir in list(filter(lambda d: d.startswith("_"), dirs)):
                 dirs.remove(skipdir)
-            for skipfile in filter(lambda f: f.startswith("_"), files):
+            for skipfile in list(filter(lambda f: f.startswith("_"), files)):
                 files.remove(skipfile)
             for f in files:
                 exportpath = os.path.join(
@@ -125,38 +603,30 @@ class MillionPages:
                 sourcetimestamp = os.path.getmtime(source)
                 if self.destination_needs_writing(destination, sourcetimestamp):
                     os.makedirs(exportpath, exist_ok=True)
-                    shutil.copyfile(source, destination)
+                    self.mirror(source, destination)
+                self.fingerprint_file(source, destination)
+            self.bundle_theme_folder(path[1:] if path.startswith("/") else path)
 
     def process_site_folder(self):
         # read pages and start building menu (without grouping)
         # skip _ files and folders
         # copy rest to export folder
-        menus = {}
         for root, dirs, files in os.walk(self.sitepath):
             path = root[len(self.sitepath) :]
             for skipdir in list(filter(lambda d: d.startswith("_"), dirs)):
                 dirs.remove(skipdir)
             for f in files:
                 if f == "__index__.yaml":
-                    key = path
-                    menu = make_menu(key, os.path.join(root, f))
-                    keyparts = key.split("/")
-                    keyparts.pop()
-                    parentkey = "/".join(keyparts)
-                    if parentkey in menus:
-                        menus[parentkey].add_item(menu)
-                    else:
-                        self.menu = menu
-                    menus[key] = menu
+                    self.menufiles[path] = make_menu(path, os.path.join(root, f))
                 elif f == "__index__.md" or f == "__index__.markdown":
                     key = os.path.join(path, f)
-                    self.pages[key] = make_page(key, os.path.join(root, f))
+                    self.pages[key] = self.read_page(key, os.path.join(root, f))
             for skipfile in list(filter(lambda f: f.startswith("_"), files)):
                 files.remove(skipfile)
             for f in files:
                 if f.endswith((".md", ".markdown")):
                     key = os.path.join(path, f)
-                    self.pages[key] = make_page(key, os.path.join(root, f))
+                    self.pages[key] = self.read_page(key, os.path.join(root, f))
                 else:
                     exportpath = os.path.join(
                         self.exportpath, path[1:] if path.startswith("/") else path
@@ -168,37 +638,132 @@ class MillionPages:
                     sourcetimestamp = os.path.getmtime(source)
                     if self.destination_needs_writing(destination, sourcetimestamp):
                         os.makedirs(exportpath, exist_ok=True)
-                        shutil.copyfile(
-                            os.path.join(root, f), os.path.join(exportpath, f)
-                        )
-        self.menucount = len(menus)
+                        self.mirror(source, destination)
+                    self.fingerprint_file(source, destination)
+        self.assemble_menu()
         for page in self.pages.values():
             page.canonical = self.siteconfig["domain"] + page.path
 
+    def bundle_theme_folder(self, path):
+        # the _*.js and _*.css files of a theme folder, sorted, concatenated
+        # and minified into _index.js and _index.css, bundled again only when
+        # one of them changed
+        folder = os.path.join(self.themepath, path)
+        try:
+            filenames = sorted(os.listdir(folder))
+        except FileNotFoundError:
+            filenames = []
+        for extension in (".js", ".css"):
+            bundlename = "_index" + extension
+            destination = os.path.join(self.exportpath, path, bundlename)
+            outputs = [destination]
+            if self.bundleconfig["source-maps"]:
+                outputs.append(destination + ".map")
+            sources = [
+                os.path.join(folder, f)
+                for f in filenames
+                if f.startswith("_")
+                and f.endswith(extension)
+                and f != bundlename
+                and os.path.isfile(os.path.join(folder, f))
+            ]
+            if not sources:
+                for output in outputs:
+                    if output in self.output:
+                        self.remove_output(output)
+                self.fingerprint_file(destination, destination)
+                continue
+
+            stamp = hashlib.sha1(
+                repr(
+                    (
+                        [(source, make_stamp(os.stat(source))) for source in sources],
+                        self.bundleconfig,
+                    )
+                ).encode()
+            ).hexdigest()
+            bundled = self.cache and self.cache.get("bundle", destination, stamp)
+            if bundled and all(os.path.isfile(output) for output in outputs):
+                for output in outputs:
+                    self.set_status(output, 0)
+            else:
+                files = []
+                for source in sources:
+                    with open(source, "r", encoding="utf-8") as sourcefile:
+                        sourcepath = os.path.relpath(source, self.themepath)
+                        files.append(
+                            ("/" + sourcepath.replace(os.sep, "/"), sourcefile.read())
+                        )
+                content, sourcemap, errors = make_bundle(
+                    bundlename,
+                    files,
+                    self.bundleconfig["minify"],
+                    self.bundleconfig["source-maps"],
+                )
+                self.errors.extend(errors)
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                self.write_output(destination, content)
+                if sourcemap:
+                    self.write_output(destination + ".map", sourcemap)
+                if self.cache:
+                    self.cache.set("bundle", destination, stamp, True)
+            self.fingerprint_file(destination, destination)
+
+    def fingerprint_file(self, source, destination):
+        # the copy of a mirrored file with the content hash in its name, an
+        # unchanged file keeps its hash, the copy of a previous version (or of
+        # a removed file) is removed
+        if not self.fingerprint or not destination.lower().endswith(self.fingerprint):
+            return
+        path = "/" + os.path.relpath(destination, self.exportpath).replace(os.sep, "/")
+        previous = self.assets.pop(path, None)
+        if os.path.isfile(source):
+            stamp = make_stamp(os.stat(source))
+            digest = None
+            if self.cache:
+                digest = self.cache.get("fingerprint", source, stamp)
+            if not digest:
+                digest = file_digest(source)[:10]
+                if self.cache:
+                    self.cache.set("fingerprint", source, stamp, digest)
+            name, extension = os.path.splitext(path)
+            self.assets[path] = f"{name}.{digest}{extension}"
+            fingerprinted = os.path.join(self.exportpath, self.assets[path][1:])
+            if self.destination_needs_writing(fingerprinted, os.path.getmtime(source)):
+                self.mirror(source, fingerprinted)
+        if previous and previous != self.assets.get(path):
+            self.remove_output(os.path.join(self.exportpath, previous[1:]))
+
+    def asset_url(self, path):
+        # the fingerprinted url for the url path of a theme or site file
+        return self.assets.get(path, path)
+
+    def assemble_menu(self):
+        # (re)build the menu tree from the parsed __index__.yaml files, in the
+        # order they were found, build_menu adds the group items later on
+        menus = {}
+        for key, menufile in self.menufiles.items():
+            if isinstance(menufile, Error):
+                menu = menufile
+            else:
+                menu = Menu(key, menufile.config)
+            keyparts = key.split("/")
+            keyparts.pop()
+            parentkey = "/".join(keyparts)
+            if parentkey in menus:
+                menus[parentkey].add_item(menu)
+            else:
+                self.menu = menu
+            menus[key] = menu
+        self.menucount = len(menus)
+
     def build_menu(self, menu, pages):
 
         if "pages" in menu.config:
             if "filter" in menu.config["pages"]:
-                filteredpages = []
-                for page in pages:
-                    match = True
-                    for key, value in menu.config["pages"]["filter"].items():
-                        if key not in page.config or page.config[key] != value:
-                            match = False
-                    if match:
-                        filteredpages.append(page)
-                pages = filteredpages
+                pages = self.pageindex.filter(pages, menu.config["pages"]["filter"])
             if "order" in menu.config["pages"]:
-                order = menu.config["pages"]["order"].split()
-                orderby = order.pop(0)
-                reverse = "desc" in order
-                default = "!!!!!!!!" if reverse else "zzzzzzzz"
-                decorated = [
-                    (page.config.get(orderby, default) + page.path, page)
-                    for page in pages
-                ]
-                decorated.sort(reverse=reverse)
-                pages = [entry[1] for entry in decorated]
+                pages = self.pageindex.order(pages, menu.config["pages"]["order"])
 
         menu.set_pages(pages)
 
@@ -213,13 +778,15 @@ class MillionPages:
                         continue
                     group = groupconfig["by"].split()
                     groupby = group.pop(0)
-                    group = Group(menu.path, groupby, groupconfig, pages)
+                    group = Group(
+                        menu.path, groupby, groupconfig, pages, self.pageindex
+                    )
                     for groupname, groupedpages in group.groups.items():
                         context = {"group": groupname}
                         config = group.config.copy()
                         for key in config:
                             if isinstance(config[key], str):
-                                template = self.jinja.from_string(config[key])
+                                template = self.template_from_string(config[key])
                                 try:
                                     config[key] = template.render(**context)
                                 except Exception as e:
@@ -237,22 +804,345 @@ class MillionPages:
         for item in menu.items:
             self.print_menu(item, indent + "  ")
 
-    def generate_site(self):
+    def generate_site(self, changes=None):
+        # with changes, only the outputs that depend on them are rendered
+        self.plan = {}
         for page in self.pages.values():
-            self.write_page(page.path, page)
+            page.bodies = {}  # the menu may have changed
+            self.plan.setdefault(page.path, ("page", page))
         self.generate_menu(self.menu)
 
+        # the resizes of changed images are made again, only by the outputs
+        # that still use them
+        if changes is not None:
+            for target in self.dependencies.image_targets(changes):
+                self.remove_output(target)
+
+        templates = {}
+        variables = set()
+        for kind in ("page", "index"):
+            templates[kind], kindvariables = template_sources(
+                self.jinja,
+                self.themeloader,
+                "/".join((self.templatesfolder, f"{kind}.html")),
+            )
+            variables.update(kindvariables)
+        # all outputs may refer to fingerprinted files, with asset(), and to
+        # any page in the menu, when the templates use it
+        structure = (
+            menu_structure(self.menu, "menu" in variables),
+            tuple(sorted(self.assets.items())),
+        )
+        if structure != self.dependencies.structure:
+            changes = None
+
+        outputs = {}
+        renders = []
+        for path, (kind, item) in self.plan.items():
+            if kind == "page":
+                sources = templates[kind] | {item.source}
+                signature = None
+            else:
+                sources = templates[kind].union(page.source for page in item.pages)
+                signature = (
+                    tuple(page.path for page in item.pages),
+                    repr(item.menu.config),
+                    item.number,
+                    item.count,
+                )
+            # the search index gets the terms of a page when it is rendered
+            # for its own path, so a page it doesn't have yet is rendered
+            unindexed = (
+                self.search
+                and kind == "page"
+                and path == item.path
+                and not self.search.document(item.canonical)
+            )
+            if (
+                changes is None
+                or unindexed
+                or self.dependencies.needs_rendering(path, sources, signature, changes)
+            ):
+                renders.append(path)
+            outputs[path] = (sources, signature)
+
+        self.imagejobs = {}
+        self.renderedimages = {}  # path as key, the images it read as value
+        self.searchdocuments = {}  # url as key, (digest, title, terms) as value
+        if self.jobs > 1 and len(renders) > 1:
+            results = render_in_parallel(self, renders, self.jobs)
+            for (
+                output,
+                errors,
+                imagejobs,
+                images,
+                documents,
+                instruments,
+                hits,
+            ) in results:
+                # outputs shared between workers (resized images) keep the
+                # status of the worker that actually wrote them
+                for destination, status in output.items():
+                    self.output[destination] = max(
+                        status, self.output.get(destination, 0)
+                    )
+                self.errors.extend(errors)
+                self.imagejobs.update(imagejobs)
+                self.renderedimages.update(images)
+                self.searchdocuments.update(documents)
+                self.instruments.merge(instruments)
+                if self.cache:
+                    for section, (sectionhits, misses) in hits.items():
+                        counts = self.cache.hits.setdefault(section, [0, 0])
+                        counts[0] += sectionhits
+                        counts[1] += misses
+                for kind, (calls, seconds) in instruments.counters["outputs"].items():
+                    self.progress.add(kind, calls)
+                if self.interrupted():
+                    break
+            results.close()  # stops the workers, if interrupted
+            self.progress.done()
+            self.check_interrupted()
+        else:
+            for path in renders:
+                self.check_interrupted()
+                self.render_output(path)
+            self.progress.done()
+
+        removed = self.dependencies.update(outputs, structure, self.renderedimages)
+        for path in removed:
+            destination = os.path.join(self.exportpath, path[1:], "index.html")
+            self.remove_output(destination)
+        with self.instruments.measure("tasks", "resize images"):
+            self.generate_images()
+
+    def generate_search_index(self):
+        # the index lists the url and title of every page, its terms are
+        # split up in shards, only the shards with terms that were added or
+        # removed are written again (unless all outputs are new), the terms
+        # of the pages come from rendering them, pages that weren't rendered
+        # again keep theirs
+        if not self.search:
+            return
+        searchpath = os.path.join(self.exportpath, "_api", "search")
+        indexdestination = os.path.join(searchpath, "index.json")
+        documents = {}
+        for page in self.pages.values():
+            document = self.searchdocuments.get(page.canonical)
+            if document is None:
+                digest, url, title, terms = self.search.document(page.canonical)
+                document = (digest, title, terms)
+            documents[page.canonical] = document
+        changedterms = self.search.update(documents)
+
+        shards = self.search.make_shards()
+        samelayout = shards.keys() == self.search.shards.keys()
+        if indexdestination in self.output and samelayout:
+            self.search.shards = shards
+            prefixes = {self.search.shard_of(term) for term in changedterms}
+        else:
+            for prefix in self.search.shards.keys() - shards.keys():
+                self.remove_output(os.path.join(searchpath, "terms", prefix + ".json"))
+            self.search.shards = shards
+            prefixes = shards.keys()
+
+        os.makedirs(os.path.join(searchpath, "terms"), exist_ok=True)
+        for prefix in prefixes:
+            self.write_output(
+                os.path.join(searchpath, "terms", prefix + ".json"),
+                json.dumps(
+                    self.search.shard(prefix), ensure_ascii=False, separators=(",", ":")
+                ),
+            )
+        urls, titles = self.search.urls()
+        index = {"shards": sorted(shards), "urls": urls, "titles": titles}
+        self.write_output(
+            indexdestination,
+            json.dumps(index, ensure_ascii=False, separators=(",", ":")),
+        )
+        if self.cache:
+            self.cache.set("search", "", "ids", self.search.ids)
+
+    def index_page(self, page):
+        # the search terms of a page, from its title and the content rendered
+        # for its own path, only tokenized again when these changed
+        title = str(page.config.get("title", ""))
+        digest = hashlib.sha1(
+            "\0".join((title, page.content)).encode("utf-8")
+        ).hexdigest()
+        previous = self.search.document(page.canonical)
+        if previous and previous[0] == digest:
+            terms = previous[3]
+        else:
+            terms = tokenize(" ".join((title, page.content)))
+        self.searchdocuments[page.canonical] = (digest, title, terms)
+
+    def render_output(self, path):
+        start = time.perf_counter()
+        kind, item = self.plan[path]
+        self.imagesread = {}
+        if kind == "page":
+            self.write_page(path, item)
+            if self.search and path == item.path:
+                self.index_page(item)
+        else:
+            self.write_index(item)
+        self.renderedimages[path] = self.imagesread
+        if self.lowmemory:
+            for page in [item] if kind == "page" else item.pages:
+                page.content = None
+                page.bodies = {}
+        kind = "pages" if kind == "page" else "indices"
+        seconds = time.perf_counter() - start
+        self.instruments.add("outputs", kind, 1, seconds)
+        self.instruments.add_output(path, seconds)
+        self.progress.add(kind)
+
+    def render_outputs(self, paths):
+        # runs in a worker process, only the outputs, errors and queued
+        # images of these paths are sent back to be merged into the generation
+        self.output = {}
+        self.errors = []
+        self.imagejobs = {}
+        self.renderedimages = {}
+        self.searchdocuments = {}
+        self.instruments = Instruments()
+        self.progress.enabled = False  # the generation shows the progress
+        hits = {}
+        if self.cache:
+            self.cache.hits = hits
+        for path in paths:
+            self.render_output(path)
+        if self.cache:
+            self.cache.close()
+        return (
+            self.output,
+            self.errors,
+            self.imagejobs,
+            self.renderedimages,
+            self.searchdocuments,
+            self.instruments,
+            hits,
+        )
+
+    def generate_images(self):
+        # the image filters only queue the resized images, they're generated
+        # here in one go, in parallel when there are multiple jobs
+        if self.lazyimages is not None:
+            self.list_lazy_images()
+        else:
+            self.errors.extend(self.generate_queued_images(self.imagejobs))
+        self.imagejobs = {}
+
+    def list_lazy_images(self):
+        # the queued resizes are added to the ones still listed, resizes that
+        # are no longer used are dropped from the list
+        lazyimages = {
+            target: job
+            for target, job in self.lazyimages.items()
+            if target in self.output
+        }
+        if not self.imagejobs and len(lazyimages) == len(self.lazyimages):
+            return
+        lazyimages.update(self.imagejobs)
+        self.lazyimages = lazyimages
+        write_lazy_images(
+            self.exportpath + ".images.json", self.exportpath, self.lazyimages
+        )
+
     def generate_menu(self, menu):
+        # plan the pages and index for this menu, first one for a path wins
         if menu._is_group:
             for page in menu.pages:
                 path = "/".join([menu.path, page.name])
-                self.write_page(path, page)
-        self.write_index(menu)
+                self.plan.setdefault(path, ("page", page))
+        for page in menu.pages:
+            if menu.path == "/":
+                path = page.path
+            else:
+                path = "/".join([menu.path, page.name])
+            self.plan.setdefault(path, ("page", page))
+        for pagination in menu.paginate():
+            self.plan.setdefault(pagination.path, ("index", pagination))
         for item in menu.items:
             self.generate_menu(item)
 
+    def render_content(self, path, page):
+        # always render from the original content, so the result for a path
+        # doesn't depend on where the page was rendered before, the images
+        # its image filters read are kept with it, they're read by every
+        # output it is rendered in
+        template, perpath = self.content_template(page.rawcontent)
+        key = path if perpath else None
+        if key not in page.bodies:
+            contentcontext = {
+                "config": page.config,
+                "menu": self.menu,
+                "path": path,
+                "site": self.siteconfig,
+            }
+            imagesread, self.imagesread = self.imagesread, {}
+            try:
+                with self.instruments.measure("templates", "(page content)"):
+                    body = template.render(**contentcontext)
+                page.bodies[key] = (body, self.imagesread)
+            except Exception as e:
+                raise
+                self.errors.append(f"page content: {path} - {str(e)}")
+            finally:
+                self.imagesread = imagesread
+        body, images = page.bodies[key]
+        for source, targets in images.items():
+            self.imagesread.setdefault(source, set()).update(targets)
+        return body
+
+    def content_template(self, content):
+        # page content is compiled once, whatever the number of pages and
+        # paths it is rendered for, and it only needs rendering per path if
+        # it refers to the path (or the menu, which marks the current path)
+        digest = hashlib.sha1(content.encode("utf-8")).hexdigest()
+        if self.lowmemory and len(self.contenttemplates) >= 1000:
+            self.contenttemplates = {}  # compiled again when needed
+        if digest not in self.contenttemplates:
+            perpath = self.cache.get("content", digest, "") if self.cache else None
+            if perpath is None:
+                variables = meta.find_undeclared_variables(self.jinja.parse(content))
+                perpath = "path" in variables or "menu" in variables
+                if self.cache:
+                    self.cache.set("content", digest, "", perpath)
+            self.contenttemplates[digest] = (
+                self.jinja.from_string(content),
+                perpath,
+            )
+        return self.contenttemplates[digest]
+
+    def template_from_string(self, source):
+        # from_string, but through the bytecode cache, group titles are mostly
+        # the same from one run to the next, page contents aren't cached this
+        # way, that would leave a file behind for every edit
+        bytecodecache = self.jinja.bytecode_cache
+        if not bytecodecache:
+            return self.jinja.from_string(source)
+        name = "string:" + hashlib.sha1(source.encode("utf-8")).hexdigest()
+        bucket = bytecodecache.get_bucket(self.jinja, name, None, source)
+        if bucket.code is None:
+            bucket.code = self.jinja.compile(source)
+            bytecodecache.set_bucket(bucket)
+        return self.jinja.template_class.from_code(
+            self.jinja, bucket.code, self.jinja.make_globals(None), None
+        )
+
+    def precompile_templates(self, target):
+        # compile the theme templates to python modules in the target folder
+        prefix = self.templatesfolder + "/"
+        self.jinja.overlay(loader=self.themeloader).compile_templates(
+            target,
+            filter_func=lambda name: name.startswith(prefix),
+            zip=None,
+            ignore_errors=False,
+        )
+
     def write_page(self, path, page):
-        print(".", end="", flush=True)
         # print(f"page  | {path:80}")
 
         exportpath = os.path.join(self.exportpath, path[1:])  # skip leading /
@@ -260,18 +1150,7 @@ class MillionPages:
         filename = "index.html"
 
         page.url = path
-        contentcontext = {
-            "config": page.config,
-            "menu": self.menu,
-            "path": path,
-            "site": self.siteconfig,
-        }
-        template = self.jinja.from_string(page.content)
-        try:
-            page.content = template.render(**contentcontext)
-        except Exception as e:
-            raise
-            self.errors.append(f"page content: {path} - {str(e)}")
+        page.content = self.render_content(path, page)
 
         context = {
             "page": page,
@@ -281,48 +1160,51 @@ class MillionPages:
         }
 
         destination = os.path.join(exportpath, filename)
-        if self.destination_needs_writing(destination, self.starttime):
-            with open(os.path.join(exportpath, filename), "w") as htmlfile:
-                template = self.jinja.get_template(
-                    "/".join((self.templatesfolder, "page.html"))
-                )
-                try:
-                    html = template.render(**context)
-                    htmlfile.write(html)
-                except Exception as e:
-                    raise
-                    self.errors.append(f"page : {path} - {str(e)}")
+        template = self.jinja.get_template(
+            "/".join((self.templatesfolder, "page.html"))
+        )
+        try:
+            with self.instruments.measure("templates", template.name):
+                html = template.render(**context)
+        except Exception as e:
+            raise
+            self.errors.append(f"page : {path} - {str(e)}")
+        self.write_output(destination, html)
 
-    def write_index(self, menu):
-        print("+", end="", flush=True)
-        # print(f"index | {menu.path:80} ({len(menu.pages):-2})")
+    def write_index(self, pagination):
+        # renders one page of the index, with only the pages on that page
+        menu = pagination.menu
+        # print(f"index | {pagination.path:80} ({len(pagination.pages):-2})")
 
-        exportpath = os.path.join(self.exportpath, menu.path[1:])  # skip leading /
+        exportpath = os.path.join(self.exportpath, pagination.path[1:])  # skip /
         os.makedirs(exportpath, exist_ok=True)
         filename = "index.html"
 
-        for page in menu.pages:
+        for page in pagination.pages:
             if menu.path == "/":
                 page.url = page.path
             else:
                 page.url = "/".join([menu.path, page.name])
-            self.write_page(page.url, page)
+            page.content = self.render_content(page.url, page)
 
+        index = copy.copy(menu)
+        index.pages = pagination.pages
         context = {
-            "index": menu,
+            "index": index,
+            "pagination": pagination,
             "menu": self.menu,
-            "path": menu.path,
+            "path": pagination.path,
             "site": self.siteconfig,
         }
 
         destination = os.path.join(exportpath, filename)
-        if self.destination_needs_writing(destination, self.starttime):
-            with open(destination, "w") as htmlfile:
-                template = self.jinja.get_template(
-                    "/".join((self.templatesfolder, "index.html"))
-                )
-                try:
-                    html = template.render(**context)
-                    htmlfile.write(html)
-                except Exception as e:
-                    self.errors.append(f"index: {menu.path} - {str(e)}")
+        template = self.jinja.get_template(
+            "/".join((self.templatesfolder, "index.html"))
+        )
+        try:
+            with self.instruments.measure("templates", template.name):
+                html = template.render(**context)
+        except Exception as e:
+            self.errors.append(f"index: {pagination.path} - {str(e)}")
+            return
+        self.write_output(destination, html)
@@ -0,0 +1,100 @@
+import os
+import errno
+import shutil
+
+try:
+    import fcntl
+except ImportError:  # not on windows
+    fcntl = None
+
+# linux ioctl that shares the source's data blocks with the destination
+# (copy-on-write), on filesystems that support it (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# errors that mean a method can't be used here at all (across devices, or
+# not supported by the filesystem, the kernel or the platform), after any
+# other error the next method is only used for that one file
+UNSUPPORTED = {
+    errno.EXDEV,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+    errno.ENOTTY,
+    errno.EINVAL,
+    errno.ENOSYS,
+}
+
+
+def hardlink(source, destination):
+    os.link(source, destination)
+
+
+def reflink(source, destination):
+    if not fcntl:
+        raise OSError(
+            errno.EOPNOTSUPP, "reflinks are not supported on this platform"
+        )
+    with open(source, "rb") as sourcefile, open(destination, "wb") as destfile:
+        fcntl.ioctl(destfile.fileno(), FICLONE, sourcefile.fileno())
+
+
+def copy_range(source, destination):
+    # copy within the kernel, without moving the data through python
+    with open(source, "rb") as sourcefile, open(destination, "wb") as destfile:
+        remaining = os.fstat(sourcefile.fileno()).st_size
+        while remaining > 0:
+            if hasattr(os, "copy_file_range"):
+                copied = os.copy_file_range(
+                    sourcefile.fileno(), destfile.fileno(), remaining
+                )
+            else:
+                copied = os.sendfile(
+                    destfile.fileno(), sourcefile.fileno(), None, remaining
+                )
+            if not copied:
+                break
+            remaining -= copied
+    if remaining > 0:
+        raise OSError(f"incomplete copy: {source}")
+
+
+def copy(source, destination):
+    shutil.copyfile(source, destination)
+
+
+# each strategy falls back to the ones after it
+STRATEGIES = {
+    "hardlink": (hardlink, reflink, copy_range, copy),
+    "reflink": (reflink, copy_range, copy),
+    "copy-range": (copy_range, copy),
+    "copy": (copy,),
+}
+
+
+def make_mirror(strategy):
+    if strategy not in STRATEGIES:
+        raise ValueError(
+            f"asset-mirroring should be one of {', '.join(STRATEGIES)}, not {strategy}"
+        )
+    failed = set()  # a method that turns out not to be supported here is skipped
+
+    def mirror(source, destination):
+        # the destination is removed first, if it is a hardlink to the
+        # source, writing into it would write into the source as well
+        try:
+            os.remove(destination)
+        except FileNotFoundError:
+            pass
+        methods = [method for method in STRATEGIES[strategy] if method not in failed]
+        for method in methods[:-1]:
+            try:
+                return method(source, destination)
+            except OSError as e:
+                try:
+                    os.remove(destination)
+                except FileNotFoundError:
+                    pass
+                if e.errno in UNSUPPORTED:
+                    failed.add(method)
+        methods[-1](source, destination)
+
+    return mirror
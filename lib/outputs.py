@@ -0,0 +1,41 @@
+import os
+from collections.abc import MutableMapping
+
+
+class OutputStatuses(MutableMapping):
+    # self.output for the low-memory mode, a dict of output pathname and
+    # status, but the pathnames are kept relative to the export folder and
+    # as utf-8 bytes, which is about half the memory for a million outputs
+    def __init__(self, exportpath):
+        self.prefix = exportpath + os.sep
+        self.statuses = {}
+
+    def key(self, pathname):
+        if not pathname.startswith(self.prefix):
+            raise KeyError(pathname)
+        return pathname[len(self.prefix) :].encode("utf-8")
+
+    def __getitem__(self, pathname):
+        return self.statuses[self.key(pathname)]
+
+    def __setitem__(self, pathname, status):
+        self.statuses[self.key(pathname)] = status
+
+    def __delitem__(self, pathname):
+        del self.statuses[self.key(pathname)]
+
+    def __contains__(self, pathname):
+        try:
+            return self.key(pathname) in self.statuses
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        for key in self.statuses:
+            yield self.prefix + key.decode("utf-8")
+
+    def __len__(self):
+        return len(self.statuses)
+
+    def values(self):
+        return self.statuses.values()
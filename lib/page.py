@@ -4,7 +4,21 @@ import markdown
 from .error import Error
 
 
-def parse(pathname):
+def parse_config(pathname):
+    # only the front-matter, without reading (or converting) the markdown
+    with open(pathname, "r") as mdfile:
+        if mdfile.readline() != "---\n":
+            return {}
+        lines = []
+        for line in mdfile:
+            if line == "---\n":
+                configpart = "".join(lines).strip()
+                return yaml.safe_load(configpart) if configpart else {}
+            lines.append(line)
+    return {}  # no closing ---, so it isn't front-matter
+
+
+def parse(pathname, markdownconfig):
     pageconfig = {}
     pagehtml = ""
     with open(pathname, "r") as mdfile:
@@ -22,29 +36,107 @@ def parse(pathname):
             mdpart = mdcontent
 
         if mdpart:
-            pagehtml = markdown.markdown(mdpart)
+            pagehtml = markdown.markdown(mdpart, **markdownconfig)
 
     return pageconfig, pagehtml
 
 
-def make_page(key, pathname):
+def make_page(key, pathname, markdownconfig, cache=None):
     try:
-        config, content = parse(pathname)
+        if cache:
+            stamp = cache.stamp(pathname)
+            parsed = cache.get("page", pathname, stamp)
+            if not parsed:
+                parsed = parse(pathname, markdownconfig)
+                cache.set("page", pathname, stamp, parsed)
+            config, content = parsed
+        else:
+            config, content = parse(pathname, markdownconfig)
     except Exception as e:
         return Error(str(e))
     filename = os.path.basename(key)
     path = os.path.dirname(key)
     if not filename.startswith("__index__."):
         path = os.path.join(path, os.path.splitext(filename)[0])
-    return Page(path, config, content)
+    return Page(path, config, content, pathname)
+
+
+def make_lazy_page(key, pathname, reader):
+    try:
+        config = reader.config(pathname)
+    except Exception as e:
+        return Error(str(e))
+    filename = os.path.basename(key)
+    path = os.path.dirname(key)
+    if not filename.startswith("__index__."):
+        path = os.path.join(path, os.path.splitext(filename)[0])
+    return LazyPage(path, config, pathname, reader)
+
+
+class PageReader:
+    # reads pages for the low-memory mode, through the build cache if there
+    # is one, the content is only converted when it is needed
+    def __init__(self, markdownconfig, cache=None):
+        self.markdownconfig = markdownconfig
+        self.cache = cache
+
+    def config(self, pathname):
+        if self.cache:
+            parsed = self.cache.get("page", pathname, self.cache.stamp(pathname))
+            if parsed:
+                return parsed[0]
+        return parse_config(pathname)
+
+    def content(self, pathname):
+        if not self.cache:
+            return parse(pathname, self.markdownconfig)[1]
+        stamp = self.cache.stamp(pathname)
+        parsed = self.cache.get("page", pathname, stamp)
+        if not parsed:
+            parsed = parse(pathname, self.markdownconfig)
+            self.cache.set("page", pathname, stamp, parsed)
+        return parsed[1]
 
 
 class Page:
-    def __init__(self, path, config, content):
+    __slots__ = (
+        "source",
+        "path",
+        "name",
+        "config",
+        "rawcontent",
+        "content",
+        "bodies",
+        "canonical",
+        "url",
+    )
+
+    def __init__(self, path, config, content, source):
+        self.source = source
         self.path = path
         if not path.startswith("/"):
             self.path = "/" + path
         pathlist = self.path.split("/")
         self.name = pathlist.pop()
         self.config = config
-        self.content = content
+        self.rawcontent = content  # unrendered
+        self.content = content  # rendered for the current url
+        self.bodies = {}  # rendered content, per path if it depends on it
+
+
+class LazyPage(Page):
+    # a page that only keeps its front-matter, the content is read again
+    # every time it is needed, and forgotten after rendering
+    __slots__ = ("reader",)
+
+    def __init__(self, path, config, source, reader):
+        self.reader = reader
+        super().__init__(path, config, None, source)
+
+    @property
+    def rawcontent(self):
+        return self.reader.content(self.source)
+
+    @rawcontent.setter
+    def rawcontent(self, content):
+        pass  # never kept
@@ -0,0 +1,106 @@
+def hashable(value):
+    # front-matter values as dict keys, equal values give equal keys
+    if isinstance(value, list):
+        return tuple(hashable(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(
+            (key, hashable(item)) for key, item in sorted(value.items(), key=repr)
+        )
+    if isinstance(value, set):
+        return frozenset(hashable(item) for item in value)
+    return value
+
+
+class PageIndex:
+    # inverted index of the front-matter of all pages, built once per
+    # generation, so filtering, ordering and grouping the pages of a menu
+    # are set operations instead of scans over all pages
+    def __init__(self, pages):
+        self.pages = list(pages)
+        self.numbers = {id(page): number for number, page in enumerate(self.pages)}
+        self.values = {}  # key as key, {value: page numbers} as value
+        self.members = {}  # same, but with list values split up, for grouping
+        self.orders = {}  # order as key, {page number: rank} as value
+        for number, page in enumerate(self.pages):
+            for key, value in page.config.items():
+                values = self.values.setdefault(key, {})
+                values.setdefault(hashable(value), set()).add(number)
+
+    def numbers_of(self, pages):
+        return {self.numbers[id(page)] for page in pages}
+
+    def filter(self, pages, conditions):
+        # the pages that have all the key: value conditions, in the same order
+        matches = None
+        for key, value in conditions.items():
+            found = self.values.get(key, {}).get(hashable(value), set())
+            matches = found if matches is None else matches & found
+        if matches is None:
+            return list(pages)
+        return [page for page in pages if self.numbers[id(page)] in matches]
+
+    def order(self, pages, order):
+        # order is "key" or "key desc", every order is sorted only once for
+        # all pages, a selection of pages is then ordered by rank, unless
+        # values of the pages can't be ordered together, then only the
+        # selection is sorted, as it may not have the pages with those values
+        if order not in self.orders:
+            try:
+                self.orders[order] = {
+                    number: rank
+                    for rank, number in enumerate(
+                        self.sort(range(len(self.pages)), order)
+                    )
+                }
+            except TypeError:
+                self.orders[order] = None
+        ranks = self.orders[order]
+        if ranks is None:
+            numbers = self.sort([self.numbers[id(page)] for page in pages], order)
+            return [self.pages[number] for number in numbers]
+        return sorted(pages, key=lambda page: ranks[self.numbers[id(page)]])
+
+    def sort(self, numbers, order):
+        # the page numbers, sorted by the value for the order and the path
+        orderparts = order.split()
+        orderby = orderparts.pop(0)
+        reverse = "desc" in orderparts
+        default = "!!!!!!!!" if reverse else "zzzzzzzz"
+        decorated = []
+        for number in numbers:
+            page = self.pages[number]
+            decorated.append((page.config.get(orderby, default) + page.path, number))
+        decorated.sort(reverse=reverse)
+        return [number for value, number in decorated]
+
+    def groups(self, pages, key):
+        # group value as key, the numbers of the pages in that group as value,
+        # the groups are collected once for all pages, unless values of the
+        # pages can't be group values, then only for the selection
+        numbers = self.numbers_of(pages)
+        if key not in self.members:
+            try:
+                self.members[key] = self.collect_members(
+                    set().union(*self.values.get(key, {}).values()), key
+                )
+            except TypeError:
+                self.members[key] = None
+        members = self.members[key]
+        if members is None:
+            return self.collect_members(numbers, key)
+        return {
+            member: found & numbers
+            for member, found in members.items()
+            if not found.isdisjoint(numbers)
+        }
+
+    def collect_members(self, numbers, key):
+        members = {}
+        for number in numbers:
+            config = self.pages[number].config
+            if key not in config:
+                continue
+            value = config[key]
+            for member in value if isinstance(value, list) else [value]:
+                members.setdefault(member, set()).add(number)
+        return members
@@ -0,0 +1,38 @@
+import time
+import queue
+
+
+class BuildScheduler:
+    # takes the changed paths from the watcher, and starts a build once no
+    # new paths came in for the quiet period (or after the maximum delay,
+    # for a steady stream of changes), builds run one after the other in the
+    # calling process, so never at the same time, a build that is
+    # interrupted by new changes is started again with those added
+    def __init__(self, events, build, quietperiod=0.05, maximumdelay=1.0):
+        self.events = events
+        self.build = build  # build(changes, interrupted) is False if interrupted
+        self.quietperiod = quietperiod
+        self.maximumdelay = maximumdelay
+
+    def run(self):
+        changes = set()
+        while True:
+            if not changes:
+                changes.add(self.events.get())  # wait for something to change
+            self.collect(changes)
+            if self.build(changes, self.interrupted):
+                changes = set()
+
+    def collect(self, changes):
+        deadline = time.monotonic() + self.maximumdelay
+        while True:
+            timeout = min(self.quietperiod, deadline - time.monotonic())
+            if timeout <= 0:
+                return
+            try:
+                changes.add(self.events.get(timeout=timeout))
+            except queue.Empty:
+                return
+
+    def interrupted(self):
+        return not self.events.empty()
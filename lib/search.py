@@ -0,0 +1,107 @@
+import re
+import html
+
+TAGS = re.compile(r"<[^>]+>")
+WORDS = re.compile(r"\w\w+")
+
+
+def tokenize(text):
+    # the distinct lowercased words (of two characters or more) in html
+    return frozenset(WORDS.findall(html.unescape(TAGS.sub(" ", text)).lower()))
+
+
+class SearchIndex:
+    # inverted index for client side search, every term has the ids of the
+    # pages it is on, ids stay the same for the same url, so a changed page
+    # only changes the shards with the terms it gained or lost
+    def __init__(self, shardsize, ids=None):
+        self.shardsize = shardsize
+        self.ids = dict(ids or {})  # url as key, id as value
+        self.nextid = max(self.ids.values(), default=-1) + 1
+        self.documents = {}  # id as key, (digest, url, title, terms) as value
+        self.postings = {}  # term as key, page ids as value
+        self.shards = {}  # prefix as key, terms as value
+
+    def document(self, url):
+        # (digest, url, title, terms) of the url, or None
+        return self.documents.get(self.ids.get(url))
+
+    def update(self, documents):
+        # documents has url as key, (digest, title, terms) as value, only
+        # documents with a different digest change the postings, returns the
+        # changed terms
+        changedterms = set()
+        for url, (digest, title, terms) in documents.items():
+            if url not in self.ids:
+                self.ids[url] = self.nextid
+                self.nextid += 1
+            pageid = self.ids[url]
+            previous = self.documents.get(pageid)
+            if previous and previous[0] == digest:
+                continue
+            changedterms |= self.set_terms(pageid, terms)
+            self.documents[pageid] = (digest, url, title, terms)
+
+        for url in [url for url in self.ids if url not in documents]:
+            pageid = self.ids.pop(url)
+            if pageid in self.documents:
+                changedterms |= self.set_terms(pageid, frozenset())
+                del self.documents[pageid]
+        return changedterms
+
+    def set_terms(self, pageid, terms):
+        oldterms = frozenset()
+        if pageid in self.documents:
+            oldterms = self.documents[pageid][3]
+        postings = self.postings
+        for term in terms - oldterms:
+            pageids = postings.get(term)
+            if pageids is None:
+                postings[term] = {pageid}
+            else:
+                pageids.add(pageid)
+        for term in oldterms - terms:
+            postings[term].discard(pageid)
+            if not postings[term]:
+                del postings[term]
+        return terms ^ oldterms
+
+    def make_shards(self):
+        # prefix as key, terms as value, the terms are split up by their
+        # first character, and a shard with more postings than the shard size
+        # is split up by one more character, terms as long as the prefix stay
+        shards = {}
+
+        def split(prefix, terms):
+            size = sum(len(self.postings[term]) for term in terms)
+            if prefix and (size <= self.shardsize or len(prefix) >= 8):
+                shards[prefix] = sorted(terms)
+                return
+            longer = {}
+            for term in terms:
+                if len(term) > len(prefix):
+                    longer.setdefault(term[: len(prefix) + 1], []).append(term)
+                else:
+                    shards.setdefault(prefix, []).append(term)
+            for longerprefix, longerterms in sorted(longer.items()):
+                split(longerprefix, longerterms)
+
+        split("", list(self.postings))
+        return shards
+
+    def shard_of(self, term):
+        for length in range(len(term), 0, -1):
+            if term[:length] in self.shards:
+                return term[:length]
+        return None
+
+    def shard(self, prefix):
+        return {term: sorted(self.postings[term]) for term in self.shards[prefix]}
+
+    def urls(self):
+        urls = [None] * self.nextid
+        titles = [None] * self.nextid
+        for digest, url, title, terms in self.documents.values():
+            urls[self.ids[url]] = url
+            titles[self.ids[url]] = title
+        return urls, titles
@@ -0,0 +1,148 @@
+import os
+import stat
+import mimetypes
+from collections import namedtuple
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import unquote
+
+from .compress import ENCODINGS, accepted_encodings
+from .manifest import read_manifest
+
+# same attributes as sanic's content range, for response.file(_range=...)
+ByteRange = namedtuple("ByteRange", ["start", "end", "size", "total"])
+
+
+class StaticFile:
+    def __init__(self, location, stats, mimetype, encoding=None):
+        self.location = location
+        self.size = stats.st_size
+        self.mtime = stats.st_mtime
+        self.mimetype = mimetype
+        self.encoding = encoding
+        self.etag = f'"{stats.st_mtime_ns:x}-{stats.st_size:x}'
+        self.etag += f'-{encoding}"' if encoding else '"'
+        self.lastmodified = formatdate(stats.st_mtime, usegmt=True)
+        self.variants = {}  # content-encoding as key, StaticFile as value
+        self.immutable = False  # fingerprinted, so it never changes
+
+    def negotiate(self, acceptencoding):
+        # the precompressed variant the browser accepts, or the file itself
+        accepted = accepted_encodings(acceptencoding)
+        for encoding, variant in self.variants.items():
+            if encoding in accepted or "*" in accepted:
+                return variant
+        return self
+
+    def headers(self):
+        headers = {
+            "ETag": self.etag,
+            "Last-Modified": self.lastmodified,
+            "Cache-Control": "no-cache",
+            "Accept-Ranges": "bytes",
+        }
+        if self.immutable:
+            headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        if self.variants or self.encoding:
+            headers["Vary"] = "Accept-Encoding"
+        if self.encoding:
+            headers["Content-Encoding"] = self.encoding
+        return headers
+
+    def not_modified(self, requestheaders):
+        ifnonematch = requestheaders.get("if-none-match")
+        if ifnonematch:
+            etags = [etag.strip() for etag in ifnonematch.split(",")]
+            return "*" in etags or self.etag in etags or "W/" + self.etag in etags
+        ifmodifiedsince = requestheaders.get("if-modified-since")
+        if ifmodifiedsince:
+            try:
+                since = parsedate_to_datetime(ifmodifiedsince).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return int(self.mtime) <= since
+        return False
+
+    def byterange(self, rangeheader):
+        # a ByteRange for a single "bytes=start-end" range, None when there
+        # is no (usable) range so the whole file is sent, raises ValueError
+        # when the range is outside the file
+        if not rangeheader or not rangeheader.startswith("bytes="):
+            return None
+        ranges = rangeheader[len("bytes=") :].split(",")
+        if len(ranges) != 1:
+            return None  # multipart ranges aren't supported, send it all
+        start, _, end = ranges[0].strip().partition("-")
+        try:
+            if start:
+                start = int(start)
+                end = min(int(end), self.size - 1) if end else self.size - 1
+            else:
+                start = max(self.size - int(end), 0)  # the last end bytes
+                end = self.size - 1
+        except ValueError:
+            return None
+        if start > end or start >= self.size:
+            raise ValueError(f"range not satisfiable: {rangeheader}")
+        return ByteRange(start, end, end - start + 1, self.size)
+
+
+class StaticFiles:
+    # url path as key, StaticFile (or None if there's no such file) as value,
+    # so a request doesn't have to look at the file system, the table is
+    # emptied when the build counter changes, after every (re)generation,
+    # the fingerprinted files are read from the assets manifest then
+    def __init__(self, exportpath, buildcounter, assetspath=None):
+        self.exportpath = exportpath
+        self.buildcounter = buildcounter
+        self.assetspath = assetspath
+        self.generation = None
+        self.files = {}
+        self.fingerprinted = set()  # url paths
+
+    def lookup(self, urlpath):
+        if self.buildcounter.value != self.generation:
+            self.generation = self.buildcounter.value
+            self.files = {}
+            if self.assetspath:
+                self.fingerprinted = set(read_manifest(self.assetspath).values())
+        if urlpath not in self.files:
+            staticfile = self.find(urlpath)
+            if staticfile and unquote(urlpath) in self.fingerprinted:
+                staticfile.immutable = True
+                for variant in staticfile.variants.values():
+                    variant.immutable = True
+            self.files[urlpath] = staticfile
+        return self.files[urlpath]
+
+    def forget(self, urlpath):
+        # after the file was (re)generated outside of a build
+        self.files.pop(urlpath, None)
+
+    def find(self, urlpath):
+        location = os.path.normpath(
+            os.path.join(self.exportpath, unquote(urlpath).lstrip("/"))
+        )
+        if location != self.exportpath and not location.startswith(
+            self.exportpath + os.sep
+        ):
+            return None
+        try:
+            stats = os.stat(location)
+            if stat.S_ISDIR(stats.st_mode):
+                location = os.path.join(location, "index.html")
+                stats = os.stat(location)
+        except OSError:
+            return None
+        if not stat.S_ISREG(stats.st_mode):
+            return None
+        mimetype = mimetypes.guess_type(location)[0] or "text/plain"
+        staticfile = StaticFile(location, stats, mimetype)
+        for encoding, suffix in ENCODINGS.items():
+            try:
+                variantstats = os.stat(location + suffix)
+            except OSError:
+                continue
+            staticfile.variants[encoding] = StaticFile(
+                location + suffix, variantstats, mimetype, encoding
+            )
+        return staticfile
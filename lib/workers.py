@@ -0,0 +1,32 @@
+import multiprocessing
+
+# the generation is handed to the workers through this global, forked
+# workers get a copy of the complete state (pages, menu, jinja environment)
+# without pickling any of it
+_generation = None
+
+
+def _render(paths):
+    return _generation.render_outputs(paths)
+
+
+def render_in_parallel(generation, paths, jobs):
+    # render the planned outputs for paths over jobs worker processes, yields
+    # the results per chunk of paths, in the order of paths, the workers are
+    # stopped when the generator is closed before it is done
+    global _generation
+    _generation = generation
+    chunksize = max(1, len(paths) // (jobs * 4))
+    chunks = [paths[i : i + chunksize] for i in range(0, len(paths), chunksize)]
+    try:
+        with multiprocessing.get_context("fork").Pool(jobs) as pool:
+            yield from pool.imap(_render, chunks)
+    finally:
+        _generation = None
+
+
+def run_in_parallel(function, arguments, jobs):
+    # function(*args) for every args in arguments over jobs worker processes,
+    # function must be importable from a module
+    with multiprocessing.get_context("fork").Pool(jobs) as pool:
+        return pool.starmap(function, arguments)